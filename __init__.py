@@ -1,4 +1,6 @@
 from .asi_stage_hw import ASIStageHW
+from .asi_stage_group import ASIStageGroupHW
 from .asi_stage_control_measure import ASIStageControlMeasure
-from .asi_stage_raster import ASIStageDelay2DScan
-from .asi_stage_pos_list import ASIStagePositionList
\ No newline at end of file
+from .asi_stage_raster import ASIStageDelay2DScan, ASIStageFly2DScan
+from .asi_stage_pos_list import ASIStagePositionList
+from .asi_stage_timelapse import ASIStageTimeLapse
\ No newline at end of file
@@ -0,0 +1,177 @@
+'''
+asyncio driver for ASI LX-4000 controllers.
+
+Shares command formatting and reply parsing with ASIXYStage, but never
+blocks the event loop: the serial port is used with timeout=0 and
+replies are awaited until the ETX terminator arrives. One event loop
+can then drive the stage alongside other devices, and wait on several
+controller cards (1H Z, 2H XY, 3F filter wheel) at once.
+
+usage:
+    stage = AsyncASIXYStage.open('COM5')
+    await stage.move_xy(1.0, 2.0)
+    await stage.wait_until_idle()
+    x, y, z = await stage.read_positions()
+'''
+import asyncio
+import time
+
+from .asi_stage_dev import ASIXYStage
+
+
+class AsyncSerialStream(object):
+    """
+    Non-blocking wrapper around a serial.Serial-like transport.
+    Wakes on readability of the port's file descriptor where available
+    (posix), otherwise polls the transport every poll_interval seconds.
+    """
+
+    def __init__(self, ser, poll_interval=0.001):
+        self.ser = ser
+        self.ser.timeout = 0 # non-blocking reads
+        self.poll_interval = poll_interval
+        self._rx_buf = bytearray()
+        self.lock = asyncio.Lock()
+
+    def write(self, data):
+        self.ser.write(data)
+
+    def _fileno(self):
+        try:
+            return self.ser.fileno()
+        except Exception:
+            return None
+
+    async def _wait_readable(self):
+        fd = self._fileno()
+        if fd is None:
+            await asyncio.sleep(self.poll_interval)
+            return
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(fd, readable.set)
+        try:
+            await readable.wait()
+        finally:
+            loop.remove_reader(fd)
+
+    async def read_frame(self, terminator=b'\x03', timeout=1.0):
+        buf = self._rx_buf
+        t0 = time.monotonic()
+        while True:
+            i = buf.find(terminator)
+            if i >= 0:
+                frame = bytes(buf[:i])
+                del buf[:i+1]
+                return frame
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+            if chunk:
+                buf += chunk
+                continue
+            if time.monotonic() - t0 > timeout:
+                raise IOError("ASI stage took too long too respond")
+            try:
+                await asyncio.wait_for(self._wait_readable(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def discard_input(self):
+        self._rx_buf.clear()
+        n = self.ser.in_waiting
+        if n:
+            self.ser.read(n)
+
+    def close(self):
+        self.ser.close()
+
+
+class AsyncASIXYStage(object):
+
+    unit_scale = 1e4 # convert internal units 1/10um to mm
+    _scale = ASIXYStage._scale
+    move_xy_cmd = ASIXYStage.move_xy_cmd
+
+    def __init__(self, stream, debug=False):
+        self.stream = stream
+        self.debug = debug
+
+    @classmethod
+    def open(cls, port='COM5', debug=False, transport=None):
+        """open port (or wrap a pre-opened transport such as
+        ASIStageSimulator) and return a new AsyncASIXYStage"""
+        if transport is None:
+            import serial
+            transport = serial.Serial(port=port, baudrate=115200, timeout=0,
+                                      bytesize=8, parity='N',
+                                      stopbits=1, xonxoff=0, rtscts=0)
+        transport.write(b'\b') # abort current command and flush input buffer
+        return cls(AsyncSerialStream(transport), debug=debug)
+
+    def close(self):
+        self.stream.close()
+
+    async def transaction(self, cmd, timeout=1.0):
+        async with self.stream.lock:
+            self.stream.discard_input()
+            if self.debug: print("ASI async cmd:", repr(cmd))
+            self.stream.write((cmd + '\r').encode())
+            frame = await self.stream.read_frame(timeout=timeout)
+        if self.debug: print("ASI async resp:", repr(frame))
+        return frame
+
+    async def batch(self, cmds, timeout=1.0):
+        """send several commands in one write and collect one reply frame
+        per command: a single round trip for the whole batch"""
+        async with self.stream.lock:
+            self.stream.discard_input()
+            if self.debug: print("ASI async batch:", cmds)
+            self.stream.write(''.join(cmd + '\r' for cmd in cmds).encode())
+            return [await self.stream.read_frame(timeout=timeout) for cmd in cmds]
+
+    async def ask(self, cmd):
+        return ASIXYStage.parse_reply(await self.transaction(cmd))
+
+    async def is_busy(self, card='2H'):
+        return ASIXYStage.parse_status(await self.transaction(card + "/"))
+
+    async def is_busy_cards(self, cards=('2H', '1H')):
+        """busy flags of several cards from one pipelined round trip"""
+        frames = await self.batch([card + "/" for card in cards])
+        return [ASIXYStage.parse_status(frame) for frame in frames]
+
+    async def read_positions(self, z=True):
+        """returns (x, y, z) in mm, or (x, y) if z is False"""
+        x, y = (await self.ask("2HW X Y")).split()
+        pos = (float(x)/self.unit_scale, float(y)/self.unit_scale)
+        if z:
+            pos += (float(await self.ask("1HW Z"))/self.unit_scale,)
+        return pos
+
+    async def move_xy(self, x=None, y=None):
+        """absolute move of x and/or y with a single command"""
+        cmd = self.move_xy_cmd(x, y)
+        if cmd is not None:
+            await self.ask(cmd)
+
+    async def move_z(self, z):
+        await self.ask("1HM Z= {:d}".format(self._scale(z)))
+
+    async def halt(self, cards=('2H', '1H')):
+        for card in cards:
+            await self.ask(card + "HALT")
+
+    async def wait_until_idle(self, cards=('2H', '1H'), poll_interval=0.020, timeout=10):
+        """wait until none of the given controller cards reports busy.
+        All pending cards are polled in one pipelined round trip (the port
+        is shared, so separate polls could not overlap); cards that are
+        already idle are not polled again."""
+        t0 = time.monotonic()
+        pending = list(cards)
+        while pending:
+            busy = await self.is_busy_cards(pending)
+            pending = [card for card, b in zip(pending, busy) if b]
+            if not pending:
+                return
+            if time.monotonic() - t0 > timeout:
+                raise IOError("ASI stage took too long during wait")
+            await asyncio.sleep(poll_interval)
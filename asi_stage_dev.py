@@ -2,17 +2,30 @@ import serial
 import time
 import threading
 
+from .asi_stage_motion import move_duration
+from .asi_stage_io import ASIStageIOWorker, command_priority, command_verb, PRIORITY_MOVE, PRIORITY_CONFIG, PRIORITY_POLL
+from .asi_stage_metrics import CommandMetrics
+from .asi_stage_traffic import TrafficRecorder
+
 class ASIXYStage(object):
     
-    def __init__(self, port='COM5', debug=False):
+    def __init__(self, port='COM5', debug=False, transport=None, traffic_log=None):
+        """transport: optional pre-opened serial.Serial-like object
+        (e.g. asi_stage_sim.ASIStageSimulator or asi_stage_traffic.TrafficReplay).
+        If None, port is opened.
+        traffic_log: file to record all serial traffic to, see asi_stage_traffic.py"""
         self.port = port
         self.debug = debug
-        self.ser = serial.Serial(port=self.port,
+        if transport is None:
+            transport = serial.Serial(port=self.port,
                          baudrate=115200,
                          # waiting time for response [s]
                          timeout=0.02,
                          bytesize=8, parity='N', 
                          stopbits=1, xonxoff=0, rtscts=0)
+        if traffic_log:
+            transport = TrafficRecorder(transport, traffic_log)
+        self.ser = transport
 
         self.ser.write(b'\b') # <del>  or  <bs>- Abort current command and flush input buffer
         #self.ser.flush() # flush output buffer
@@ -28,7 +41,44 @@ class ASIXYStage(object):
         # threading lock
         self.lock = threading.Lock()
         
+        # receive buffer for ETX-framed replies
+        self._rx_buf = bytearray()
+        
+        # optional I/O thread that owns the port, see start_io_thread()
+        self.io = None
+        
+        # number of motion command edges (halt/move/home), see _port_transaction
+        self.move_count = 0
+        
+        # latency of every port transaction by verb, waits, retries, timeouts
+        self.metrics = CommandMetrics()
+        
+        # motion model for predictive waits, see predict_arrival()
+        # speed [mm/s], acc [ms], backlash [mm] as last set by this driver
+        self.axis_params = dict((ax, dict(speed=None, acc=None, backlash=0.0)) for ax in 'XYZ')
+        self.known_pos = dict() # axis -> last read or commanded position [mm]
+        self.arrival = {'1H': 0.0, '2H': 0.0} # predicted arrival (time.monotonic), None if unknown
+        self.arrival_margin = 0.010 # [s] wake up this much before predicted arrival
+        
+        # XY ring buffer of stored positions, see ring_buffer_load()
+        self.ring_buffer_size = 50 # positions per upload
+        self._ring_supported = None # unknown until probed
+        self._ring_targets = [] # (x, y) in mm, as loaded
+        self._ring_pointer = 0
+        
+    def start_io_thread(self):
+        """route all transactions through a dedicated I/O thread
+        with a priority queue (halt > move > config > poll).
+        Identical pending polls are coalesced."""
+        if self.io is None:
+            self.io = ASIStageIOWorker(name="ASI stage I/O {}".format(self.port))
+            self.io.start()
+        return self.io
+        
     def close(self):
+        if self.io is not None:
+            self.io.stop()
+            self.io = None
         self.ser.close()
         
     def send_cmd(self, cmd):
@@ -37,48 +87,102 @@ class ASIXYStage(object):
         self.ser.write(cmd_bytes)
         if self.debug: print ("ASI XY done sending cmd")
     
-    def info(self,axis):
+    def _read_frame(self, timeout=1.0):
+        """read until end-of-text (ETX) is received and return the frame
+        without the ETX. Everything waiting in the input buffer is read in
+        one call; when it is empty we block in read(1) until the next byte
+        arrives (or the serial timeout expires), so we return as soon as the
+        controller has finished its reply."""
+        buf = self._rx_buf
+        t0 = time.time()
+        while True:
+            i = buf.find(b'\x03')
+            if i >= 0:
+                frame = bytes(buf[:i])
+                del buf[:i+1]
+                return frame
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+            if chunk:
+                buf += chunk
+            elif time.time()-t0 > timeout:
+                raise IOError("ASI stage took too long too respond")
+
+    def _discard_input(self):
+        """drop stale bytes, e.g. a late reply to a command that timed out"""
+        self._rx_buf.clear()
+        n = self.ser.in_waiting
+        if n:
+            self.ser.read(n)
+
+    def _transaction(self, cmd, timeout=1.0):
+        if self.io is not None:
+            priority = command_priority(cmd)
+            key = cmd if priority == PRIORITY_POLL else None
+            return self.io.call(priority, self._port_transaction, cmd, timeout, key=key)
+        return self._port_transaction(cmd, timeout)
+
+    def _port_transaction(self, cmd, timeout=1.0):
+        moving = command_priority(cmd) <= PRIORITY_MOVE
         with self.lock:
-            self.send_cmd("2HI "+axis)
-            time.sleep(0.010)
-            resp1 = self.ser.readline().decode()+" "
-            if self.debug: print("ASI XY ask resp1:", repr(resp1))
-            #read until end-of-text is received
-            t0 = time.time()
-            timeout = 10
-            resp = 'output:\n '
-            while True:
-                resp2 = self.ser.readline()
-                if self.debug: print("ASI XY ask resp2:", repr(resp2))
-                if resp2 == b'\x03':
-                    break
-                resp2 = resp2.decode()+" "
-                resp = resp+resp2
-                if time.time()-t0 > timeout:
-                    raise IOError("ASI stage took too long too respond")
+            # move_count changes before and after every motion command,
+            # so position readings that overlap a move can be detected
+            if moving: self.move_count += 1
+            t0 = time.perf_counter()
+            try:
+                self._discard_input()
+                self.send_cmd(cmd)
+                frame = self._read_frame(timeout)
+            except IOError:
+                self.metrics.count('timeouts')
+                raise
+            finally:
+                if moving: self.move_count += 1
+                self.metrics.record(command_verb(cmd), time.perf_counter() - t0)
+        if self.debug: print("ASI XY resp:", repr(frame))
+        return frame
+
+    def _batch(self, cmds, timeout=1.0):
+        """send several commands in one write and collect one reply frame
+        per command: a single round trip for the whole batch"""
+        if self.io is not None:
+            return self.io.call(PRIORITY_CONFIG, self._port_batch, cmds, timeout)
+        return self._port_batch(cmds, timeout)
+
+    def _port_batch(self, cmds, timeout=1.0):
+        """the round trip is recorded once, under the verb of the first command"""
+        with self.lock:
+            t0 = time.perf_counter()
+            try:
+                self._discard_input()
+                data = ''.join(cmd + '\r' for cmd in cmds).encode()
+                if self.debug: print("ASI XY batch:", len(cmds), "cmds")
+                self.ser.write(data)
+                return [self._read_frame(timeout) for cmd in cmds]
+            except IOError:
+                self.metrics.count('timeouts')
+                raise
+            finally:
+                self.metrics.record(command_verb(cmds[0]), time.perf_counter() - t0)
+
+    def info(self,axis):
+        frame = self._transaction("2HI "+axis, timeout=10)
+        lines = frame.decode().splitlines(True)
+        resp = 'output:\n '
+        for line in lines[1:]:
+            resp = resp+line+" "
         return resp
     
     def ask(self, cmd): # format: '2HW X' -> ':A 355'
-        with self.lock:
-            self.send_cmd(cmd)
-            time.sleep(0.020)
-            resp1 = self.ser.readline()
-            if self.debug: print("ASI XY ask resp1:", repr(resp1))
-            #read until end-of-text is received
-            t0 = time.time()
-            timeout = 1
-            while True:
-                resp2 = self.ser.readline()
-                if self.debug: print("ASI XY ask resp2:", repr(resp2))
-                if resp2 == b'\x03':
-                    break
-                if time.time()-t0 > timeout:
-                    raise IOError("ASI stage took too long too respond")
-
-        
-        assert resp2 == b'\x03' # End of text (Escape sequence)
-        
-        resp1 = resp1.decode()
+        try:
+            return self.parse_reply(self._transaction(cmd))
+        except AssertionError:
+            self.metrics.count('errors')
+            raise
+    
+    @staticmethod
+    def parse_reply(frame):
+        """b':A 355 \\r\\n' -> '355'"""
+        resp1 = frame.decode().split('\n', 1)[0]
         
         assert resp1.startswith(":A")
         
@@ -86,66 +190,172 @@ class ASIXYStage(object):
             print("ASI-stage communication error: ERR0")
         else:
             return resp1[2:].strip() # remove whitespace
+    
+    @staticmethod
+    def parse_status(frame):
+        """b'B\\r\\n' -> True (busy), b'N\\r\\n' -> False"""
+        resp1 = frame.decode()
+        assert resp1[0] in 'NB'
+        return resp1[0] == 'B'
 
 
     def read_pos_x(self):
         x = self.ask("2HW X")
-        return float(x)/self.unit_scale
+        self.known_pos['X'] = x = float(x)/self.unit_scale
+        return x
     
     def read_pos_y(self):
         y = self.ask("2HW Y")
-        return float(y)/self.unit_scale
+        self.known_pos['Y'] = y = float(y)/self.unit_scale
+        return y
     
     def read_pos_z(self):
         z = self.ask("1HW Z")
-        return float(z)/self.unit_scale
+        self.known_pos['Z'] = z = float(z)/self.unit_scale
+        return z
+    
+    def read_pos_xy(self):
+        """x and y from a single query of the XY card"""
+        x, y = self.ask("2HW X Y").split()
+        x, y = float(x)/self.unit_scale, float(y)/self.unit_scale
+        self.known_pos.update(X=x, Y=y)
+        return x, y
+    
+    def read_positions(self, z=True):
+        """returns (x, y, z) in mm, or (x, y) if z is False.
+        x and y are taken at the same instant, z in the same round trip."""
+        if not z:
+            return self.read_pos_xy()
+        xy, z = [self.parse_reply(frame) for frame in self._batch(["2HW X Y", "1HW Z"])]
+        x, y = [float(v)/self.unit_scale for v in xy.split()]
+        z = float(z)/self.unit_scale
+        self.known_pos.update(X=x, Y=y, Z=z)
+        return (x, y, z)
     
     def is_busy_xy(self):
-        with self.lock:
-            self.send_cmd("2H/")  # status command has a different reply structure
-            resp1 = self.ser.readline().decode()
-            resp2 = self.ser.read(1)
-        if self.debug: print("ASI isBusy resp1", repr(resp1))
-        if self.debug: print("ASI isBusy resp2", repr(resp2))
-        assert resp1[0] in 'NB'
-        
-        if resp1[0]=='N':   return False
-        elif resp1[0]=='B': return True
+        # status command has a different reply structure: 'N' or 'B'
+        return self.parse_status(self._transaction("2H/"))
     
     def is_busy_z(self):
-        with self.lock:
-            self.send_cmd("1H/")  # status command has a different reply structure
-            resp1 = self.ser.readline().decode()
-            resp2 = self.ser.read(1)
-        assert resp1[0] in 'NB'
-        
-        if resp1[0]=='N':   return False
-        elif resp1[0]=='B': return True
+        # status command has a different reply structure: 'N' or 'B'
+        return self.parse_status(self._transaction("1H/"))
     
 
-    def wait_until_not_busy_xy(self, timeout=10):    
-        t0 = time.time()
-        while self.is_busy_xy():
-            time.sleep(0.020)
-            if time.time() - t0 > timeout:
-                raise IOError("ASI stage took too long during wait")
+    def is_busy_cards(self, cards=('2H', '1H')):
+        """busy flags of several cards from one pipelined round trip"""
+        return [self.parse_status(frame) for frame in self._batch([card + '/' for card in cards])]
+    
+    def is_busy_xyz(self):
+        return any(self.is_busy_cards(('2H', '1H')))
+    
+    def wait_until_not_busy_xy(self, timeout=10, predictive=False):    
+        self.wait_until_idle('2H', self.is_busy_xy, timeout, predictive)
 
-    def wait_until_not_busy_z(self, timeout=10):    
+    def wait_until_not_busy_z(self, timeout=10, predictive=False):    
+        self.wait_until_idle('1H', self.is_busy_z, timeout, predictive)
+    
+    def wait_until_not_busy_xyz(self, timeout=10, predictive=False):
+        """wait for XY and Z moving at the same time, polling both cards together"""
+        self.wait_until_idle(('2H', '1H'), self.is_busy_xyz, timeout, predictive)
+    
+    def wait_until_idle(self, card, is_busy, timeout=10, predictive=False, poll=0.020):
+        """poll is_busy() until False. With predictive=True, first sleep until
+        shortly before the predicted arrival on card ('1H' or '2H', or a
+        tuple of cards: the last to arrive) and then poll tightly for the
+        final settle. timeout=None waits forever"""
+        cards = (card,) if isinstance(card, str) else tuple(card)
         t0 = time.time()
-        while self.is_busy_z():
-            time.sleep(0.020)
-            if time.time() - t0 > timeout:
+        t_wait = time.perf_counter()
+        if predictive:
+            arrivals = [self.arrival[c] for c in cards]
+            if None not in arrivals:
+                last = cards[arrivals.index(max(arrivals))]
+                if self.sleep_until_arrival(last, timeout):
+                    poll = min(poll, 0.005)
+        while is_busy():
+            time.sleep(poll)
+            if timeout is not None and time.time() - t0 > timeout:
+                self.metrics.record_wait(time.perf_counter() - t_wait)
                 raise IOError("ASI stage took too long during wait")
+        self.metrics.record_wait(time.perf_counter() - t_wait)
+        for c in cards:
+            self.arrival[c] = 0.0
+    
+    def _plan_move(self, axis, target):
+        """update predicted arrival of axis' card for a move to target (mm)"""
+        card = '1H' if axis == 'Z' else '2H'
+        p = self.axis_params[axis]
+        start = self.known_pos.get(axis)
+        self.known_pos[axis] = target
+        prev = self.arrival[card]
+        if start is None or p['speed'] is None or p['acc'] is None:
+            self.arrival[card] = None # can't predict
+            return
+        T = move_duration(start, target, p['speed'], p['acc'], p['backlash'])
+        # after a move of unknown duration this may predict too early,
+        # which only means polling starts sooner
+        self.arrival[card] = max(prev or 0.0, time.monotonic() + T)
+    
+    def _forget_positions(self, axes):
+        """positions and arrival unknown, e.g. after halt or home"""
+        for axis in axes:
+            self.known_pos.pop(axis, None)
+        self.arrival['1H' if axes == 'Z' else '2H'] = None
+    
+    def predict_arrival(self, card='2H'):
+        """predicted time.monotonic() at which all moves issued on card
+        ('1H' or '2H') are complete, from a trapezoidal motion profile with
+        the speed, acceleration and backlash set through this driver.
+        None if unknown."""
+        return self.arrival[card]
+    
+    def sleep_until_arrival(self, card='2H', timeout=10):
+        """sleep until shortly before the predicted arrival on card.
+        returns False if no prediction is available"""
+        t_arrive = self.arrival[card]
+        if t_arrive is None:
+            return False
+        dt = t_arrive - self.arrival_margin - time.monotonic()
+        if timeout is not None:
+            dt = min(dt, timeout)
+        if dt > 0:
+            time.sleep(dt)
+        return True
 
             
     def move_x(self, target):
+        self._plan_move('X', self._scale(target)/self.unit_scale)
         self.ask("2HM X= {:d}".format(self._scale(target)))
             
     def move_y(self, target):
+        self._plan_move('Y', self._scale(target)/self.unit_scale)
         self.ask("2HM Y= {:d}".format(self._scale(target)))
         
     def move_z(self, target):
+        self._plan_move('Z', self._scale(target)/self.unit_scale)
         self.ask("1HM Z= {:d}".format(self._scale(target)))
+    
+    def move_xy_cmd(self, x=None, y=None):
+        """'2HM X= .. Y= ..' for the given targets, None if both are None"""
+        args = []
+        if x is not None:
+            args.append("X= {:d}".format(self._scale(x)))
+        if y is not None:
+            args.append("Y= {:d}".format(self._scale(y)))
+        if args:
+            return "2HM " + " ".join(args)
+    
+    def move_xy(self, x=None, y=None):
+        """absolute move of x and/or y with a single command,
+        both axes start at the same time"""
+        cmd = self.move_xy_cmd(x, y)
+        if cmd is None:
+            return
+        if x is not None:
+            self._plan_move('X', self._scale(x)/self.unit_scale)
+        if y is not None:
+            self._plan_move('Y', self._scale(y)/self.unit_scale)
+        self.ask(cmd)
           
     def move_x_and_wait(self, target,timeout=10):
         if int(self.read_pos_x()*self.unit_scale) == int(target*self.unit_scale):
@@ -160,6 +370,7 @@ class ASIXYStage(object):
         self.wait_until_not_busy_xy(timeout)
 
     def home_xy(self):
+        self._forget_positions('XY')
         self.ask("2HHOME X Y")
         
     def home_and_wait_xy(self, timeout=90):
@@ -172,8 +383,10 @@ class ASIXYStage(object):
 
     def set_here_z(self, target):
         self.ask("1HHERE Z= {:d}".format(self._scale(target)))
+        self.known_pos['Z'] = self._scale(target)/self.unit_scale
     
     def home_z(self):
+        self._forget_positions('Z')
         self.ask("1HHOME Z")
         
     def home_and_center_xy(self):
@@ -195,22 +408,83 @@ class ASIXYStage(object):
         
     def halt_xy(self):
         self.ask("2HHALT")
+        self._forget_positions('XY')
         
     def halt_z(self):
         self.ask("1HHALT")
+        self._forget_positions('Z')
         
     def set_limits_xy(self, xl, xu, yl, yu): # x in [xl, xu], y in [yl, yu]
         self.ask("2HSL X= {:f} Y= {:f}".format(xl, yl))
         self.ask("2HSU X=" + str(xu) + " Y=" + str(yu))
         
+    def _plan_move_rel(self, axis, step):
+        start = self.known_pos.get(axis)
+        if start is None:
+            self.arrival['1H' if axis == 'Z' else '2H'] = None
+        else:
+            self._plan_move(axis, start + int(step*self.unit_scale)/self.unit_scale)
+        
     def move_x_rel(self, step):
         if step!=0:
+            self._plan_move_rel('X', step)
             self.ask("2HR X={:d}".format(int(step*self.unit_scale)))
 
     def move_y_rel(self, step):
         if step!=0:
+            self._plan_move_rel('Y', step)
             self.ask("2HR Y={:d}".format(int(step*self.unit_scale)))
 
+    def move_xy_rel(self, step_x, step_y):
+        """relative move of both axes with a single command"""
+        args = []
+        if step_x != 0:
+            self._plan_move_rel('X', step_x)
+            args.append("X={:d}".format(int(step_x*self.unit_scale)))
+        if step_y != 0:
+            self._plan_move_rel('Y', step_y)
+            args.append("Y={:d}".format(int(step_y*self.unit_scale)))
+        if args:
+            self.ask("2HR " + " ".join(args))
+
+    def ring_buffer_supported(self):
+        """True if the firmware has the ring buffer (LOAD / RBMODE) option.
+        Probed once by clearing the buffer."""
+        if self._ring_supported is None:
+            try:
+                self.ring_buffer_clear()
+                self._ring_supported = True
+            except AssertionError:
+                self._ring_supported = False
+        return self._ring_supported
+
+    def ring_buffer_clear(self):
+        self.ask("2HRM X=0")
+        self._ring_targets = []
+        self._ring_pointer = 0
+
+    def ring_buffer_load(self, xs, ys):
+        """replace the XY ring buffer with positions xs, ys (mm) in one
+        pipelined upload of at most ring_buffer_size positions"""
+        assert len(xs) <= self.ring_buffer_size
+        self.ring_buffer_clear()
+        targets = [(self._scale(x), self._scale(y)) for x, y in zip(xs, ys)]
+        frames = self._batch(["2HLD X= {:d} Y= {:d}".format(x, y) for x, y in targets])
+        for frame in frames:
+            self.parse_reply(frame)
+        self._ring_targets = [(x/self.unit_scale, y/self.unit_scale) for x, y in targets]
+
+    def ring_buffer_step(self):
+        """move to the next position in the ring buffer. This is still one
+        serial round trip per position (a short command without targets);
+        the controller only advances by itself on a TTL trigger, which is
+        not configured here"""
+        x, y = self._ring_targets[self._ring_pointer]
+        self._ring_pointer = (self._ring_pointer + 1) % len(self._ring_targets)
+        self._plan_move('X', x)
+        self._plan_move('Y', y)
+        self.ask("2HRM")
+
     def set_backlash_xy(self, backlash_x, backlash_y=None):
         if backlash_y is None:
             backlash_y = backlash_x
@@ -223,12 +497,16 @@ class ASIXYStage(object):
         disables the anti-backlash algorithm for that axis
         """
         self.ask("2HB X= {:1.4f} Y= {:1.4f}".format(backlash_x,backlash_y))
+        self.axis_params['X']['backlash'] = backlash_x
+        self.axis_params['Y']['backlash'] = backlash_y
         
     def set_backlash_z(self, backlash_z):
         self.ask("1HB Z= {:1.4f}".format(backlash_z))
+        self.axis_params['Z']['backlash'] = backlash_z
     
     def move_z_rel(self, step):
         if step!=0:
+            self._plan_move_rel('Z', step)
             self.ask("1HR Z={:d}".format(int(step*self.unit_scale)))
 
         
@@ -256,15 +534,20 @@ class ASIXYStage(object):
         per second. Maximum speed is = 7.5 mm/s for standard 6.5 mm pitch leadscrews.
         """
         self.ask("2HSPEED X= {:1.4f} Y= {:1.4f}".format(speed_x,speed_y))
+        self.axis_params['X']['speed'] = speed_x
+        self.axis_params['Y']['speed'] = speed_y
     
     def set_speed_x(self, speed_x):
         self.ask("2HSPEED X= {:1.4f}".format(speed_x))
+        self.axis_params['X']['speed'] = speed_x
     
     def set_speed_y(self, speed_y):
         self.ask("2HSPEED Y= {:1.4f}".format(speed_y))
+        self.axis_params['Y']['speed'] = speed_y
         
     def set_speed_z(self, speed_z):
         self.ask("1HSPEED Z= {:1.4f}".format(speed_z))
+        self.axis_params['Z']['speed'] = speed_z
         
     def set_acc_xy(self, acc_x, acc_y=None):
         if acc_y is None:
@@ -278,6 +561,13 @@ class ASIXYStage(object):
         determine the t_step).
         """
         self.ask("2HAC X= {:1.4f} Y= {:1.4f}".format(acc_x,acc_y))    
+        self.axis_params['X']['acc'] = acc_x
+        self.axis_params['Y']['acc'] = acc_y
+    
+    def set_acc_z(self, acc_z):
+        """ramp time of Z in ms, see set_acc_xy"""
+        self.ask("1HAC Z= {:1.4f}".format(acc_z))
+        self.axis_params['Z']['acc'] = acc_z
         
     def _scale(self, val):
         """returns integer value for built-in 
@@ -291,8 +581,10 @@ class ASIXYStage(object):
     
     def zero_xy(self):
         self.ask("2HZERO")
+        self.known_pos.update(X=0.0, Y=0.0)
     def zero_z(self):
         self.ask("1HZERO")
+        self.known_pos['Z'] = 0.0
     #### z-stage
         
     
\ No newline at end of file
@@ -0,0 +1,189 @@
+'''
+Focus surface z(x, y) fitted to any number of marked focus points.
+
+Models:
+    plane   robust least-squares plane (Tukey biweight IRLS), >= 3 points
+    poly2   robust 2nd order polynomial, >= 6 points
+    tps     thin-plate spline, optionally smoothed, >= 3 points
+
+With fewer points than a model needs, the next simpler model is used
+(1 or 2 points: constant mean z).
+
+build_grid() evaluates the model once on a regular grid; z() then does
+an O(1) bilinear lookup per point (vectorized for arrays). Points
+outside the grid are evaluated with the model directly.
+'''
+import numpy as np
+
+FOCUS_MODELS = ('plane', 'poly2', 'tps')
+
+
+class FocusMap(object):
+
+    def __init__(self, points=None, model='plane', smoothing=0.0):
+        """
+        points: (N, 3) array-like of (x, y, z) in mm
+        smoothing: thin-plate spline regularization (0: interpolating)
+        """
+        self.model = model
+        self.smoothing = smoothing
+        self.points = np.zeros((0, 3))
+        self.grid = None # (x0, y0, dx, dy, Z)
+        self._grid_args = None
+        self.set_points(points if points is not None else [])
+
+    def __len__(self):
+        return len(self.points)
+
+    def set_points(self, points):
+        self.points = np.array(points, dtype=float).reshape(-1, 3)
+        self.fit()
+
+    def add_point(self, x, y, z):
+        self.set_points(np.vstack([self.points, [x, y, z]]))
+
+    def clear(self):
+        self.set_points([])
+
+    def set_model(self, model, smoothing=None):
+        assert model in FOCUS_MODELS
+        self.model = model
+        if smoothing is not None:
+            self.smoothing = smoothing
+        self.fit()
+
+    @property
+    def fitted_model(self):
+        """model actually used for the current number of points"""
+        n = len(self.points)
+        if n == 0:
+            return None
+        if n < 3:
+            return 'constant'
+        if self.model == 'poly2' and n < 6:
+            return 'plane'
+        return self.model
+
+    def fit(self):
+        m = self.fitted_model
+        P = self.points
+        if m is None:
+            self.coef = None
+        elif m == 'constant':
+            self.coef = np.array([P[:, 2].mean()])
+        elif m in ('plane', 'poly2'):
+            self.coef = robust_lstsq(self._poly_terms(m, P[:, 0], P[:, 1]), P[:, 2])
+        elif m == 'tps':
+            self.coef = self._fit_tps()
+        self.grid = None
+        if self._grid_args is not None:
+            self.build_grid(*self._grid_args)
+
+    @staticmethod
+    def _poly_terms(model, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        one = np.ones_like(x)
+        if model == 'plane':
+            return np.stack([one, x, y], axis=-1)
+        return np.stack([one, x, y, x*x, x*y, y*y], axis=-1)
+
+    @staticmethod
+    def _tps_kernel(r):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(r > 0, r*r*np.log(r), 0.0)
+
+    def _fit_tps(self):
+        P = self.points
+        n = len(P)
+        r = np.hypot(P[:, None, 0] - P[None, :, 0], P[:, None, 1] - P[None, :, 1])
+        K = self._tps_kernel(r) + self.smoothing*np.eye(n)
+        Q = self._poly_terms('plane', P[:, 0], P[:, 1])
+        A = np.zeros((n+3, n+3))
+        A[:n, :n] = K
+        A[:n, n:] = Q
+        A[n:, :n] = Q.T
+        b = np.concatenate([P[:, 2], np.zeros(3)])
+        # lstsq tolerates collinear points
+        return np.linalg.lstsq(A, b, rcond=None)[0]
+
+    def evaluate(self, x, y):
+        """model z at (x, y), scalars or arrays"""
+        m = self.fitted_model
+        if m is None:
+            raise ValueError("FocusMap has no focus points")
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if m == 'constant':
+            z = np.full(np.broadcast(x, y).shape, self.coef[0])
+        elif m in ('plane', 'poly2'):
+            z = self._poly_terms(m, x, y) @ self.coef
+        else:
+            P = self.points
+            n = len(P)
+            r = np.hypot(x[..., None] - P[:, 0], y[..., None] - P[:, 1])
+            z = self._tps_kernel(r) @ self.coef[:n] + self._poly_terms('plane', x, y) @ self.coef[n:]
+        if np.ndim(z) == 0:
+            return float(z)
+        return z
+
+    def build_grid(self, x_min, x_max, y_min, y_max, n=256):
+        """cache the model on an n x n grid covering the given range"""
+        self._grid_args = (x_min, x_max, y_min, y_max, n)
+        if self.fitted_model is None:
+            self.grid = None
+            return
+        xs = np.linspace(x_min, x_max, n)
+        ys = np.linspace(y_min, y_max, n)
+        Z = self.evaluate(*np.meshgrid(xs, ys))
+        dx = (xs[-1] - xs[0])/(n-1) or 1.0
+        dy = (ys[-1] - ys[0])/(n-1) or 1.0
+        self.grid = (xs[0], ys[0], dx, dy, Z)
+
+    def z(self, x, y):
+        """focus z at (x, y) from the cached grid (exact model outside)"""
+        if self.grid is None:
+            return self.evaluate(x, y)
+        x0, y0, dx, dy, Z = self.grid
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        ny, nx = Z.shape
+        fx = (x - x0)/dx
+        fy = (y - y0)/dy
+        inside = (fx >= 0) & (fx <= nx-1) & (fy >= 0) & (fy <= ny-1)
+        ix = np.clip(np.floor(fx).astype(int), 0, nx-2)
+        iy = np.clip(np.floor(fy).astype(int), 0, ny-2)
+        tx = fx - ix
+        ty = fy - iy
+        z = ((1-tx)*(1-ty)*Z[iy, ix] + tx*(1-ty)*Z[iy, ix+1]
+             + (1-tx)*ty*Z[iy+1, ix] + tx*ty*Z[iy+1, ix+1])
+        if not np.all(inside):
+            z = np.where(inside, z, self.evaluate(x, y))
+        if np.ndim(z) == 0:
+            return float(z)
+        return z
+
+    def residuals(self):
+        """z of the focus points minus the model"""
+        P = self.points
+        if len(P) == 0:
+            return np.zeros(0)
+        return P[:, 2] - self.evaluate(P[:, 0], P[:, 1])
+
+
+def robust_lstsq(A, b, iterations=10, c=4.685):
+    """least squares A @ coef = b with Tukey biweight reweighting, so
+    a single badly focused point does not tilt the fit"""
+    coef = np.linalg.lstsq(A, b, rcond=None)[0]
+    if len(b) <= A.shape[1]:
+        return coef
+    for _ in range(iterations):
+        r = b - A @ coef
+        s = 1.4826*np.median(np.abs(r - np.median(r)))
+        if s <= 1e-12:
+            break
+        u = r/(c*s)
+        w = np.where(np.abs(u) < 1, (1 - u*u)**2, 0.0)
+        sw = np.sqrt(w)
+        coef = np.linalg.lstsq(A*sw[:, None], b*sw, rcond=None)[0]
+    return coef
@@ -0,0 +1,142 @@
+'''
+Several ASI controllers driven as one.
+
+Each member is an ASIStageHW on its own port with its own I/O thread.
+The group sends commands to all members at the same time from a thread
+pool (one worker per member), and waits on all of them concurrently, so
+total time is that of the slowest controller, not the sum.
+
+Moves without a per-member target send every member to the same sample
+position (each through its own transform). group_move() takes separate
+targets per member. Positions are read from the first member (primary).
+
+The position list and the time-lapse can bind to a group (hw_name).
+They use the group's move/wait/halt methods and read the primary's
+settings. The raster scans need a single stage and reject a group.
+'''
+from ScopeFoundry import HardwareComponent
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ASIStageGroupHW(HardwareComponent):
+
+    name = 'asi_stage_group'
+
+    def __init__(self, app, name=None, members=('asi_stage',), debug=False):
+        self.member_names = list(members)
+        HardwareComponent.__init__(self, app, debug=debug, name=name)
+
+    def setup(self):
+        self.settings.New('members', dtype=str, initial=','.join(self.member_names), ro=True)
+        self.pool = None
+        self.add_operation('Halt all', self.halt_all)
+
+    @property
+    def members(self):
+        return [self.app.hardware[name] for name in self.member_names]
+
+    @property
+    def primary(self):
+        return self.app.hardware[self.member_names[0]]
+
+    @property
+    def enable_z(self):
+        # Z commands go to the members that have a Z card
+        return any(hw.enable_z for hw in self.members)
+
+    def connect(self):
+        for hw in self.members:
+            if not hw.settings['connected']:
+                hw.settings['connected'] = True
+        self.pool = ThreadPoolExecutor(max_workers=len(self.member_names),
+                                       thread_name_prefix=self.name)
+
+    def disconnect(self):
+        # members stay connected, they are hardware components of their own
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def map(self, func, *args, **kwargs):
+        """call func(hw, *args, **kwargs) for every member concurrently,
+        returns the results in member order. Errors are raised after all
+        calls have finished."""
+        if self.pool is None:
+            return [func(hw, *args, **kwargs) for hw in self.members]
+        futures = [self.pool.submit(func, hw, *args, **kwargs) for hw in self.members]
+        errors = [f.exception() for f in futures]
+        for err in errors:
+            if err is not None:
+                raise err
+        return [f.result() for f in futures]
+
+    def group_move(self, targets):
+        """targets: {member name: (x, y) or (x, y, z)}; starts all moves at once"""
+        def move(hw):
+            target = targets.get(hw.name)
+            if target is None:
+                return
+            hw.move_xy(target[0], target[1])
+            if len(target) > 2 and target[2] is not None and hw.enable_z:
+                hw.move_z(target[2])
+        self.map(move)
+
+    def move_xy(self, x=None, y=None):
+        self.map(lambda hw: hw.move_xy(x, y))
+
+    def set_xy_target(self, x, y):
+        self.map(lambda hw: hw.set_xy_target(x, y))
+
+    def move_z(self, z):
+        # members without a Z card are skipped
+        self.map(lambda hw: hw.move_z(z) if hw.enable_z else None)
+
+    def wait_until_not_busy_xy(self, timeout=None):
+        self.map(lambda hw: hw.wait_until_not_busy_xy(timeout))
+
+    def wait_until_not_busy_z(self, timeout=None):
+        self.map(lambda hw: hw.wait_until_not_busy_z(timeout) if hw.enable_z else None)
+
+    def wait_until_not_busy_xyz(self, timeout=None):
+        self.map(lambda hw: hw.wait_until_not_busy_xyz(timeout))
+
+    def halt_each(self, func):
+        """call func(hw) for every member from the calling thread: the
+        pool workers may be blocked in waits and a halt must not queue
+        behind them. Every member is halted before an error is raised."""
+        errors = []
+        for hw in self.members:
+            try:
+                func(hw)
+            except Exception as err:
+                errors.append(err)
+        if errors:
+            raise errors[0]
+
+    def halt_xy(self):
+        self.halt_each(lambda hw: hw.halt_xy())
+
+    def halt_z(self):
+        self.halt_each(lambda hw: hw.halt_z() if hw.enable_z else None)
+
+    def halt_all(self):
+        def halt(hw):
+            hw.halt_xy()
+            if hw.enable_z:
+                hw.halt_z()
+        self.halt_each(halt)
+
+    def get_position(self, max_age_ms=None):
+        return self.primary.get_position(max_age_ms)
+
+    def positions(self, max_age_ms=None):
+        """{member name: position} read from all members concurrently"""
+        return dict(zip(self.member_names, self.map(lambda hw: hw.get_position(max_age_ms))))
+
+    def begin_motion_session(self):
+        for hw in self.members:
+            hw.begin_motion_session()
+
+    def end_motion_session(self):
+        for hw in self.members:
+            hw.end_motion_session()
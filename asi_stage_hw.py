@@ -1,5 +1,7 @@
 from ScopeFoundry import HardwareComponent
 from collections import OrderedDict
+from contextlib import contextmanager
+import json
 import threading
 import time
 import numpy as np
@@ -7,6 +9,11 @@ from qtpy import QtCore, QtWidgets
 
 try:
     from .asi_stage_dev import ASIXYStage
+    from .asi_stage_sim import ASIStageSimulator
+    from .asi_stage_io import PRIORITY_POLL
+    from .asi_stage_transform import StageTransform
+    from .asi_stage_recorder import StageTrajectoryRecorder
+    from .asi_stage_traffic import TrafficReplay
 except Exception as err:
     print("Cannot load required modules for ASI xy-stage:", err)
 
@@ -14,6 +21,15 @@ class ASIStageHW(HardwareComponent):
     
     name = 'asi_stage'
     
+    # command verbs with latency settings, verb -> setting name prefix
+    metric_verbs = OrderedDict(
+        [('W', 'where'),
+        ('M', 'move'),
+        ('R', 'move_rel'),
+        ('/', 'status'),
+        ('SPEED', 'speed'),
+        ('B', 'backlash'),])
+    
     filter_wheel_positions = OrderedDict(
         [('1_', 1),
         ('2_', 2),
@@ -56,10 +72,33 @@ class ASIStageHW(HardwareComponent):
             z_target = self.settings.New('z_target', ro=False, **xy_kwargs)  
             backlash_z = self.settings.New('backlash_z', ro=False, initial=0.00, unit='mm', spinbox_decimals=3)
             speed_z = self.settings.New("speed_z", ro=False, initial=1.20000, unit='mm/s', spinbox_decimals=5, spinbox_step=0.10000, vmin=0.00000, vmax=3.00000)
+            acc_z = self.settings.New("acc_z", ro=False, initial=10, unit='ms', spinbox_decimals=1)
             
         
         self.settings.New('port', dtype=str, initial='COM4')
         
+        # record all serial traffic of a connection to traffic_log ('' = off);
+        # port 'REPLAY' plays replay_file back instead of a controller,
+        # latencies divided by replay_speed (0 = no delay)
+        self.settings.New('traffic_log', dtype='file', initial='')
+        self.settings.New('replay_file', dtype='file', initial='')
+        self.settings.New('replay_speed', dtype=float, initial=1.0, vmin=0)
+        
+        # sample frame calibration, on top of swap_xy/invert_x/invert_y
+        self.settings.New('rotation', dtype=float, initial=0.0, unit='deg', spinbox_decimals=3)
+        self.settings.New('skew', dtype=float, initial=0.0, unit='deg', spinbox_decimals=3)
+        self.settings.rotation.add_listener(self.update_transform)
+        self.settings.skew.add_listener(self.update_transform)
+        self.update_transform()
+        
+        # serpentine scans: offset (mm) applied to reverse lines, measured
+        # per scan speed, stored as JSON {"<speed>": offset}
+        self.settings.New('direction_offsets', dtype=str, initial='{}')
+        
+        # positions younger than this are served from cache by get_position()
+        self.settings.New('position_max_age', dtype=float, initial=100, unit='ms', spinbox_decimals=0, vmin=0)
+        self._pos_cache = None # (t, move_count, pos)
+        
         self.add_operation("Halt XY", self.halt_xy)
         if self.enable_z: self.add_operation("Halt Z", self.halt_z)
         self.add_operation("Home XY", self.home_xy)
@@ -67,15 +106,61 @@ class ASIStageHW(HardwareComponent):
         
         # TODO Filter wheel is not configured
         
+        # sleep until just before the predicted end of a move instead of
+        # busy-polling from the start, see ASIXYStage.predict_arrival()
+        self.settings.New('predictive_wait', dtype=bool, initial=True)
+        
+        # adaptive polling: fast while moving, exponential back-off to a
+        # slow heartbeat when idle, paused during exclusive motion sessions
+        self.settings.New('poll_interval_fast', dtype=int, initial=50, unit='ms', vmin=10)
+        self.settings.New('poll_interval_idle', dtype=int, initial=2000, unit='ms', vmin=10)
+        self.motion_sessions = 0
+        self._poll_interval = 0.0 # s, current back-off interval
+        self._next_poll = 0.0 # monotonic time of next poll
+        self._idle_move_count = None # move_count at last confirmed idle
+        
+        # background recording of the actual trajectory, see asi_stage_recorder.py
+        self.settings.New('record_trajectory', dtype=bool, initial=False)
+        self.settings.New('record_rate', dtype=float, initial=20.0, unit='Hz', vmin=0.1, vmax=200)
+        self.settings.New('record_buffer_size', dtype=int, initial=100000, vmin=100)
+        self.settings.record_trajectory.add_listener(self.update_recording)
+        self.settings.record_rate.add_listener(self.update_recording)
+        self.recorder = None
+        
+        # command latency metrics (median and 99th percentile, ms) and
+        # counters, refreshed from the driver's histograms, see asi_stage_metrics.py
+        for verb, name in self.metric_verbs.items():
+            self.settings.New('lat_{}_p50'.format(name), dtype=float, initial=0, ro=True, unit='ms', spinbox_decimals=2)
+            self.settings.New('lat_{}_p99'.format(name), dtype=float, initial=0, ro=True, unit='ms', spinbox_decimals=2)
+        for counter in ('cmd_count', 'cmd_retries', 'cmd_failures', 'cmd_timeouts', 'cmd_errors'):
+            self.settings.New(counter, dtype=int, initial=0, ro=True)
+        self.settings.New('metrics_interval', dtype=float, initial=1.0, unit='s', vmin=0.1)
+        self._next_metrics = 0.0
+        self.add_operation("Reset metrics", self.reset_metrics)
+        
+        # the timer only decides whether a poll is due; the poll itself
+        # runs on the I/O thread
         self.update_timer = QtCore.QTimer(self)
         self.update_timer.timeout.connect(self.on_update_timer)        
-        self.update_timer.start(100)        
+        self.update_timer.start(self.settings['poll_interval_fast'])
         
     def connect(self):
         S = self.settings
         
         # Open connection to hardware
-        self.stage = ASIXYStage(port=S['port'], debug=S['debug_mode'])
+        # port 'SIM' uses an in-process simulated controller
+        if S['port'].upper() == 'SIM':
+            transport = ASIStageSimulator()
+        elif S['port'].upper() == 'REPLAY':
+            transport = TrafficReplay(S['replay_file'], speed=S['replay_speed'] or None)
+        else:
+            transport = None
+        self.stage = ASIXYStage(port=S['port'], debug=S['debug_mode'],
+                                transport=transport, traffic_log=S['traffic_log'] or None)
+        # all serial traffic goes through one prioritized I/O thread
+        self.io = self.stage.start_io_thread()
+        self.recorder = StageTrajectoryRecorder(self.read_trajectory_sample, self.io,
+                                                rate=S['record_rate'], size=S['record_buffer_size'])
                       
         # connect logged quantities
         S.x_position.connect_to_hardware(
@@ -156,6 +241,11 @@ class ASIStageHW(HardwareComponent):
                 write_func = self.set_speed_z
                 )
             S.speed_z.write_to_hardware()
+            
+            S.acc_z.connect_to_hardware(
+                write_func = self.set_acc_z
+                )
+            S.acc_z.write_to_hardware()
         
         S.x_position.read_from_hardware()
         S.y_position.read_from_hardware()
@@ -171,20 +261,27 @@ class ASIStageHW(HardwareComponent):
         self.update_thread.start()
         
         self.is_connected = True
+        self.update_recording()
         
     def disconnect(self):
         
         self.settings.disconnect_all_from_hardware()
         
+        if self.recorder is not None:
+            self.recorder.stop()
+            self.recorder = None
+        
         if hasattr(self, 'update_thread'):
             self.update_thread_interrupted = True
             self.update_thread.join(timeout=1.0)
             del self.update_thread
 
         
+        self.invalidate_position_cache()
         if hasattr(self, 'stage'):
             self.stage.close()
             del self.stage
+            del self.io
             
         self.is_connected = False
             
@@ -209,16 +306,105 @@ class ASIStageHW(HardwareComponent):
                 time.sleep(0.2)
     
     def on_update_timer(self):
-        if self.settings['connected']:
-            self.settings.y_position.read_from_hardware()
-            self.settings.x_position.read_from_hardware()
-            if self.enable_z:
-                    #print("reading z pos")
-                    self.settings.z_position.read_from_hardware()
+        S = self.settings
+        if not S['connected']:
+            return
+        now = time.monotonic()
+        if now >= self._next_metrics:
+            # also while a measurement owns the stage: no serial traffic
+            self.update_metrics()
+            self._next_metrics = now + S['metrics_interval']
+        if self.motion_sessions > 0:
+            return
+        fast = 1e-3*S['poll_interval_fast']
+        idle = 1e-3*S['poll_interval_idle']
+        moving = self.stage.move_count != self._idle_move_count
+        if moving and not self.other_observer:
+            self._poll_interval = fast
+            # react at once to a newly issued move
+            self._next_poll = min(self._next_poll, now)
+        if now < self._next_poll:
+            return
+        # non-blocking: runs on the I/O thread, coalesced if still queued
+        self.io.submit(PRIORITY_POLL, self.poll_motion, key='poll_motion')
+        if self.other_observer or not moving:
+            self._poll_interval = min(max(2*self._poll_interval, fast), idle)
             if self.other_observer:
-                self.update_timer.setInterval(1000)
-            else:
-                self.update_timer.setInterval(200)
+                self._poll_interval = idle
+        self._next_poll = now + self._poll_interval
+        self.update_timer.setInterval(S['poll_interval_fast'])
+    
+    def poll_motion(self):
+        """refresh positions and, while a move may be in flight, the
+        busy flags. Marks the stage idle once no card reports busy."""
+        move_count = self.stage.move_count
+        if move_count != self._idle_move_count:
+            busy = self.attempt_10_times(self.stage.is_busy_xy)
+            if self.enable_z and not busy:
+                busy = self.attempt_10_times(self.stage.is_busy_z)
+            if busy is False and self.stage.move_count == move_count:
+                self._idle_move_count = move_count
+        self.read_positions()
+    
+    def metrics_snapshot(self):
+        """command latency histograms and counters of the driver,
+        see CommandMetrics.snapshot()"""
+        return self.stage.metrics.snapshot()
+    
+    def reset_metrics(self):
+        if hasattr(self, 'stage'):
+            self.stage.metrics.reset()
+            self.update_metrics()
+    
+    def update_metrics(self):
+        snap = self.metrics_snapshot()
+        S = self.settings
+        for verb, name in self.metric_verbs.items():
+            stats = snap['commands'].get(verb)
+            S['lat_{}_p50'.format(name)] = stats['p50'] if stats else 0.0
+            S['lat_{}_p99'.format(name)] = stats['p99'] if stats else 0.0
+        S['cmd_count'] = sum(stats['count'] for stats in snap['commands'].values())
+        S['cmd_retries'] = snap['retries']
+        S['cmd_failures'] = snap['failures']
+        S['cmd_timeouts'] = snap['timeouts']
+        S['cmd_errors'] = snap['errors']
+    
+    def update_recording(self):
+        rec = self.recorder
+        if rec is None:
+            return
+        rec.rate = self.settings['record_rate']
+        if self.settings['record_trajectory']:
+            rec.start()
+        else:
+            rec.stop()
+    
+    def read_trajectory_sample(self):
+        """(x, y, z, busy) for the trajectory recorder, sample coordinates.
+        busy: bit 0 XY card, bit 1 Z card"""
+        pos = self.stage.read_positions(self.enable_z)
+        x, y = self.transform.to_sample(pos[0], pos[1])
+        flags = self.stage.is_busy_cards(('2H', '1H') if self.enable_z else ('2H',))
+        busy = sum(int(f) << k for k, f in enumerate(flags))
+        if self.enable_z:
+            return x, y, pos[2], busy
+        return x, y, np.nan, busy
+    
+    def begin_motion_session(self):
+        """measurement takes exclusive control of motion; background
+        polling is paused until end_motion_session()"""
+        self.motion_sessions += 1
+    
+    def end_motion_session(self):
+        self.motion_sessions = max(self.motion_sessions - 1, 0)
+    
+    @contextmanager
+    def motion_session(self):
+        self.begin_motion_session()
+        try:
+            yield self
+        finally:
+            self.end_motion_session()
 
     def halt_xy(self):
         self.stage.halt_xy()
@@ -250,66 +436,150 @@ class ASIStageHW(HardwareComponent):
         
     def set_acc_xy(self, acc):
         self.stage.set_acc_xy(acc,acc)
-        
-    def read_pos_x(self):
-        if not self.swap_xy and not self.invert_x:
-            return self.attempt_10_times(self.stage.read_pos_x)
-        elif not self.swap_xy:
-            return -self.attempt_10_times(self.stage.read_pos_x)
-        elif not self.invert_x:
-            return self.attempt_10_times(self.stage.read_pos_y)
+    
+    def set_acc_z(self, acc):
+        self.stage.set_acc_z(acc)
+        
+    def read_positions(self):
+        """read all axes in one snapshot (one query per card) and
+        refresh x_position, y_position (and z_position).
+        returns (x, y, z) or (x, y) in sample coordinates"""
+        t = time.monotonic()
+        move_count = self.stage.move_count
+        pos = self.attempt_10_times(self.stage.read_positions, self.enable_z)
+        if pos is None:
+            return None
+        x, y = self.transform.to_sample(pos[0], pos[1])
+        S = self.settings
+        S.x_position.update_value(x)
+        S.y_position.update_value(y)
+        if self.enable_z:
+            pos = (x, y, pos[2])
+            S.z_position.update_value(pos[2])
         else:
-            return -self.attempt_10_times(self.stage.read_pos_y)
+            pos = (x, y)
+        if self.stage.move_count == move_count:
+            # no motion command was issued while reading
+            self._pos_cache = (t, move_count, pos)
+        return pos
+    
+    def get_position(self, max_age_ms=None):
+        """(x, y, z) no older than max_age_ms (default: position_max_age).
+        Serves a recent reading from cache when possible, otherwise reads
+        the stage. The cache is invalidated by any motion command."""
+        if max_age_ms is None:
+            max_age_ms = self.settings['position_max_age']
+        cache = self._pos_cache
+        if cache is not None:
+            t, move_count, pos = cache
+            if move_count == self.stage.move_count and (time.monotonic() - t)*1e3 <= max_age_ms:
+                return pos
+        pos = self.read_positions()
+        if pos is None:
+            # fall back to last known position
+            S = self.settings
+            pos = (S['x_position'], S['y_position'])
+            if self.enable_z:
+                pos += (S['z_position'],)
+        return pos
+    
+    def invalidate_position_cache(self):
+        self._pos_cache = None
+
+    def read_pos_xy(self):
+        """sample (x, y) from a single query"""
+        pos = self.attempt_10_times(self.stage.read_pos_xy)
+        if pos is None:
+            return None
+        return self.transform.to_sample(*pos)
+    
+    def read_pos_x(self):
+        pos = self.read_pos_xy()
+        if pos is not None:
+            return pos[0]
 
     def read_pos_y(self):
-        if not self.swap_xy and not self.invert_y:
-            return self.attempt_10_times(self.stage.read_pos_y)
-        elif not self.swap_xy:
-            return -self.attempt_10_times(self.stage.read_pos_y)
-        elif not self.invert_y:
-            return self.attempt_10_times(self.stage.read_pos_x)
-        else:
-            return -self.attempt_10_times(self.stage.read_pos_x)
+        pos = self.read_pos_xy()
+        if pos is not None:
+            return pos[1]
 
     def move_x(self, x):
-        if not self.swap_xy and not self.invert_x:
-            return self.attempt_10_times(self.stage.move_x, x)
-        elif not self.swap_xy:
-            return self.attempt_10_times(self.stage.move_x,-x)
-        elif not self.invert_x:
-            return self.attempt_10_times(self.stage.move_y, x)
-        else:
-            return self.attempt_10_times(self.stage.move_y, -x)
+        return self.move_xy(x, None)
         
     def move_x_rel(self, x):
-        if not self.swap_xy and not self.invert_x:
-            return self.attempt_10_times(self.stage.move_x_rel, x)
-        elif not self.swap_xy:
-            return self.attempt_10_times(self.stage.move_x_rel, -x)
-        elif not self.invert_x:
-            return self.attempt_10_times(self.stage.move_y_rel, -x)
-        else:
-            return self.attempt_10_times(self.stage.move_y_rel, x)
+        return self.move_xy_rel(x, 0)
     
     def move_y(self, x):
-        if not self.swap_xy and not self.invert_y:
-            return self.attempt_10_times(self.stage.move_y, x)
-        elif not self.swap_xy:
-            return self.attempt_10_times(self.stage.move_y, -x)
-        elif not self.invert_y:
-            return self.attempt_10_times(self.stage.move_x, x)
-        else:
-            return self.attempt_10_times(self.stage.move_x, -x)
+        return self.move_xy(None, x)
         
     def move_y_rel(self, x):
-        if not self.swap_xy and not self.invert_y:
-            return self.attempt_10_times(self.stage.move_y_rel, x)
-        elif not self.swap_xy:
-            return self.attempt_10_times(self.stage.move_y_rel, -x)
-        elif not self.invert_y:
-            return self.attempt_10_times(self.stage.move_x_rel, -x)
-        else: 
-            return self.attempt_10_times(self.stage.move_x_rel, x)
+        return self.move_xy_rel(0, x)
+    
+    def move_xy(self, x=None, y=None):
+        """move to sample position (x, y) with a single controller command.
+        A coordinate given as None keeps its current target."""
+        T = self.transform
+        if not T.is_axis_aligned():
+            # rotated frame: every stage axis depends on both coordinates
+            S = self.settings
+            if x is None: x = S['x_target']
+            if y is None: y = S['y_target']
+        sx, sy = T.stage_targets(x, y)
+        return self.attempt_10_times(self.stage.move_xy, sx, sy)
+    
+    def move_stage_xy(self, sx=None, sy=None):
+        """move to stage coordinates (no sample transform), e.g. targets
+        precomputed with self.transform.to_stage()"""
+        return self.attempt_10_times(self.stage.move_xy, sx, sy)
+    
+    def ring_buffer_supported(self):
+        return bool(self.attempt_10_times(self.stage.ring_buffer_supported))
+    
+    def ring_buffer_size(self):
+        """positions per ring buffer upload"""
+        return self.stage.ring_buffer_size
+    
+    def ring_buffer_load(self, sx, sy):
+        """upload stage positions to the controller's XY ring buffer"""
+        self.stage.ring_buffer_load(sx, sy)
+    
+    def ring_buffer_step(self):
+        """move to the next ring buffer position (not retried: a retry
+        could skip a position)"""
+        self.stage.ring_buffer_step()
+    
+    def move_xy_rel(self, dx, dy):
+        sdx, sdy = self.transform.to_stage_vector(dx, dy)
+        return self.attempt_10_times(self.stage.move_xy_rel, sdx, sdy)
+    
+    def update_transform(self):
+        """rebuild the sample<->stage transform from the wiring flags
+        and the rotation/skew calibration settings"""
+        T = StageTransform.from_flags(self.swap_xy, self.invert_x, self.invert_y)
+        self.transform = T.with_calibration(self.settings['rotation'], self.settings['skew'])
+    
+    def _direction_offsets(self):
+        try:
+            return dict(json.loads(self.settings['direction_offsets']))
+        except ValueError:
+            return dict()
+    
+    def get_direction_offset(self, speed):
+        """calibrated reverse-line offset (mm) at speed (mm/s), 0 if none"""
+        return float(self._direction_offsets().get('{:.3f}'.format(speed), 0.0))
+    
+    def set_direction_offset(self, speed, offset):
+        table = self._direction_offsets()
+        table['{:.3f}'.format(speed)] = float(offset)
+        self.settings['direction_offsets'] = json.dumps(table, sort_keys=True)
+    
+    def set_xy_target(self, x, y):
+        """set x_target and y_target together and move both axes with
+        one command (setting them one by one issues two moves)"""
+        S = self.settings
+        S.x_target.update_value(x, update_hardware=False)
+        S.y_target.update_value(y, update_hardware=False)
+        return self.move_xy(x, y)
     
     def move_z(self, z):
         return self.attempt_10_times(self.stage.move_z, z)
@@ -323,15 +593,44 @@ class ASIStageHW(HardwareComponent):
     def is_busy_z(self):
         return self.attempt_10_times(self.stage.is_busy_z)
     
+    def busy_checked(self, is_busy):
+        """is_busy retried like attempt_10_times, but raises when all
+        attempts fail: a wait must not take a failed poll for idle"""
+        def checked():
+            busy = self.attempt_10_times(is_busy)
+            if busy is None:
+                raise IOError("ASI stage: cannot read busy status")
+            return busy
+        return checked
+    
+    def wait_until_not_busy_xy(self, timeout=None):
+        self.stage.wait_until_idle('2H', self.busy_checked(self.stage.is_busy_xy), timeout,
+                                   predictive=self.settings['predictive_wait'], poll=0.03)
+    
+    def wait_until_not_busy_z(self, timeout=None):
+        self.stage.wait_until_idle('1H', self.busy_checked(self.stage.is_busy_z), timeout,
+                                   predictive=self.settings['predictive_wait'], poll=0.03)
+    
+    def is_busy_xyz(self):
+        return self.attempt_10_times(self.stage.is_busy_xyz)
+    
+    def wait_until_not_busy_xyz(self, timeout=None):
+        """wait for simultaneous XY and Z moves with one combined poll"""
+        if not self.enable_z:
+            return self.wait_until_not_busy_xy(timeout)
+        self.stage.wait_until_idle(('2H', '1H'), self.busy_checked(self.stage.is_busy_xyz), timeout,
+                                   predictive=self.settings['predictive_wait'], poll=0.03)
+    
+    def read_pos_z(self):
+        return self.attempt_10_times(self.stage.read_pos_z)
+    
     def correct_backlash(self,backlash):
         self.move_x_rel(-backlash)
         self.move_y_rel(-backlash)
-        while self.stage.is_busy_xy():
-            time.sleep(0.03)
+        self.wait_until_not_busy_xy()
         self.move_x_rel(backlash)
         self.move_y_rel(backlash)    
-        while self.stage.is_busy_xy():
-            time.sleep(0.03)
+        self.wait_until_not_busy_xy()
     
         
     def attempt_10_times(self, func, *args,**kwargs):
@@ -339,9 +638,13 @@ class ASIStageHW(HardwareComponent):
         while attempts < 10:
             try:
                 retval = func(*args,**kwargs)
+                if attempts:
+                    self.stage.metrics.count('retries', attempts)
                 return retval
             except:
                 attempts +=1
+        self.stage.metrics.count('retries', attempts)
+        self.stage.metrics.count('failures')
     
     
     def linear_move_abs(self, x, y, z=None, speed=None):
@@ -354,9 +657,7 @@ class ASIStageHW(HardwareComponent):
         sy0 = self.settings['speed_y']
         sz0 = self.settings['speed_z']
         # original position
-        x0 = self.settings['x_position']
-        y0 = self.settings['y_position']
-        z0 = self.settings['z_position']
+        x0, y0, z0 = self.get_position()
 
         # compute velocity vector and set speeds
         dx = abs(x - x0)
@@ -379,8 +680,7 @@ class ASIStageHW(HardwareComponent):
         print("speed", dx/dt, dy/dt, dz/dt)
             
         # initiate move
-        self.settings['x_target'] = x
-        self.settings['y_target'] = y
+        self.set_xy_target(x, y)
         if z is not None:
             self.settings['z_target'] = z
             
@@ -0,0 +1,115 @@
+'''
+Serial I/O worker for ASI controllers.
+
+One thread owns the serial port and serves a priority queue of jobs.
+Lower numbers run first: halt beats move, move beats config, config
+beats poll. Callers get a concurrent.futures.Future back. Jobs
+submitted with a key are coalesced: while a job with the same key is
+still queued, later submissions share its Future instead of adding
+another round trip.
+'''
+import itertools
+import queue
+import re
+import threading
+from concurrent.futures import Future
+
+PRIORITY_STOP = -1
+PRIORITY_HALT = 0
+PRIORITY_MOVE = 1
+PRIORITY_CONFIG = 2
+PRIORITY_POLL = 3
+
+MOVE_VERBS = ('M', 'MOVE', 'R', 'MOVREL', 'HOME', 'H', 'HERE', 'Z', 'ZERO', 'RM', 'RBMODE')
+POLL_VERBS = ('W', 'WHERE', '/')
+
+
+def command_verb(cmd):
+    """verb of a controller command, e.g. '2HSPEED X?' -> 'SPEED'"""
+    m = re.match(r'\s*\d[A-Z]\s*(/|[A-Z]*)', cmd)
+    return m.group(1) if m else ''
+
+
+def command_priority(cmd):
+    """priority of a controller command, e.g. '2HHALT' -> PRIORITY_HALT"""
+    verb = command_verb(cmd)
+    if verb == 'HALT':
+        return PRIORITY_HALT
+    if verb == 'RM' and '=' in cmd:
+        # '2HRM X=0' clears the ring buffer, only a bare '2HRM' moves
+        return PRIORITY_CONFIG
+    if verb in MOVE_VERBS:
+        return PRIORITY_MOVE
+    if verb in POLL_VERBS:
+        return PRIORITY_POLL
+    return PRIORITY_CONFIG
+
+
+class ASIStageIOWorker(object):
+
+    def __init__(self, name='asi_stage_io'):
+        self.name = name
+        self.queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._pending = dict() # coalescing key -> Future of queued job
+        self._pending_lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def in_worker_thread(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, priority, func, *args, key=None, **kwargs):
+        """queue func(*args, **kwargs) and return a Future of its result"""
+        with self._pending_lock:
+            if key is not None and key in self._pending:
+                return self._pending[key]
+            fut = Future()
+            if key is not None:
+                self._pending[key] = fut
+            self.queue.put((priority, next(self._seq), fut, func, args, kwargs, key))
+        return fut
+
+    def call(self, priority, func, *args, key=None, **kwargs):
+        """run func on the worker thread and wait for the result.
+        Runs directly when called from the worker itself (nested calls)
+        or when the worker is not running."""
+        if self.thread is None or self.in_worker_thread():
+            return func(*args, **kwargs)
+        return self.submit(priority, func, *args, key=key, **kwargs).result()
+
+    def run(self):
+        while True:
+            priority, seq, fut, func, args, kwargs, key = self.queue.get()
+            if fut is None:
+                break
+            if key is not None:
+                with self._pending_lock:
+                    if self._pending.get(key) is fut:
+                        del self._pending[key]
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(func(*args, **kwargs))
+            except BaseException as err:
+                fut.set_exception(err)
+
+    def stop(self, timeout=1.0):
+        if self.thread is None:
+            return
+        self.queue.put((PRIORITY_STOP, next(self._seq), None, None, (), {}, None))
+        self.thread.join(timeout)
+        self.thread = None
+        # cancel jobs still queued
+        with self._pending_lock:
+            self._pending.clear()
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item[2] is not None:
+                    item[2].cancel()
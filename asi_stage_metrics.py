@@ -0,0 +1,170 @@
+'''
+Command latency metrics for the ASI driver.
+
+Every port transaction is timed and recorded in a histogram keyed by the
+command verb ('W', 'M', 'R', '/', 'SPEED', 'B', ...). Time spent in
+wait_until_idle() (sleeping and busy polling) goes into a separate
+histogram. Retries, timeouts and error replies are counted.
+
+The histograms are HDR-style: values (integer microseconds) fall into
+log-linear buckets, 64 per power of two, so every recorded value is kept
+to within ~1.5 % from 1 us to minutes at a fixed memory cost. Recording
+is a few integer operations; percentiles are only computed in snapshot().
+
+    metrics.snapshot()  ->  {'commands': {verb: stats}, 'wait': stats,
+                             'io_time': s, 'wait_time': s,
+                             'retries': n, 'failures': n, 'timeouts': n, 'errors': n}
+    stats: count, mean, p50, p90, p99, max (latencies in ms)
+'''
+import threading
+
+import numpy as np
+
+COUNTERS = ('retries', 'failures', 'timeouts', 'errors')
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, sub_bits=7, max_value=600.0):
+        """sub_bits: 2**(sub_bits-1) buckets per power of two
+        max_value: largest value (s) kept apart, larger ones are clamped"""
+        self.sub_bits = sub_bits
+        self.half = 1 << (sub_bits - 1)
+        self.max_us = int(max_value*1e6)
+        self.counts = [0]*(self._index(self.max_us) + 1)
+        self.reset()
+
+    def reset(self):
+        for k in range(len(self.counts)):
+            self.counts[k] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, v):
+        e = v.bit_length() - self.sub_bits
+        if e <= 0:
+            return v
+        return e*self.half + (v >> e)
+
+    def _bucket_value(self, index):
+        """middle of bucket index, in us"""
+        if index < 2*self.half:
+            return float(index)
+        e = index//self.half - 1
+        m = index - e*self.half
+        return ((m << e) + ((m + 1) << e))/2.0
+
+    def record(self, dt):
+        """record a latency dt in seconds"""
+        v = min(max(int(dt*1e6), 0), self.max_us)
+        self.counts[self._index(v)] += 1
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def copy(self):
+        h = LatencyHistogram.__new__(LatencyHistogram)
+        h.__dict__.update(self.__dict__)
+        h.counts = list(self.counts)
+        return h
+
+    def since(self, earlier):
+        """histogram of the values recorded after the copy earlier was
+        taken. max is known to bucket precision only."""
+        h = self.copy()
+        h.counts = [n - n0 for n, n0 in zip(self.counts, earlier.counts)]
+        h.count = self.count - earlier.count
+        h.total = self.total - earlier.total
+        nonzero = [k for k, n in enumerate(h.counts) if n]
+        h.max = min(self._bucket_value(nonzero[-1])*1e-6, self.max) if nonzero else 0.0
+        return h
+
+    def merge(self, other):
+        for k, n in enumerate(other.counts):
+            self.counts[k] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentiles(self, qs):
+        """latencies (s) at percentiles qs (0..100)"""
+        if self.count == 0:
+            return [0.0]*len(qs)
+        cum = np.cumsum(self.counts)
+        idx = np.searchsorted(cum, np.ceil(np.asarray(qs)/100.0*self.count).clip(1, None))
+        return [min(self._bucket_value(int(k))*1e-6, self.max) for k in idx]
+
+    def stats(self):
+        p50, p90, p99 = self.percentiles((50, 90, 99))
+        mean = self.total/self.count if self.count else 0.0
+        return dict(count=self.count, mean=1e3*float(mean), p50=1e3*p50, p90=1e3*p90,
+                    p99=1e3*p99, max=1e3*float(self.max))
+
+
+class CommandMetrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = dict() # verb -> LatencyHistogram
+            self.wait = LatencyHistogram()
+            self.io_time = 0.0
+            self.retries = 0
+            self.failures = 0
+            self.timeouts = 0
+            self.errors = 0
+
+    def record(self, verb, dt):
+        """a port transaction of verb took dt seconds"""
+        with self.lock:
+            hist = self.commands.get(verb)
+            if hist is None:
+                hist = self.commands[verb] = LatencyHistogram()
+            hist.record(dt)
+            self.io_time += dt
+
+    def record_wait(self, dt):
+        with self.lock:
+            self.wait.record(dt)
+
+    def count(self, counter, n=1):
+        """increment one of COUNTERS"""
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def checkpoint(self):
+        """copy of the current state, for snapshot(since=...)"""
+        with self.lock:
+            cp = CommandMetrics.__new__(CommandMetrics)
+            cp.__dict__.update(self.__dict__)
+            cp.commands = dict((verb, h.copy()) for verb, h in self.commands.items())
+            cp.wait = self.wait.copy()
+            return cp
+
+    def snapshot(self, since=None):
+        """since: a checkpoint(), only what was recorded after it is
+        reported (e.g. a single scan)"""
+        with self.lock:
+            commands = dict(self.commands)
+            wait = self.wait
+            counters = dict((c, getattr(self, c)) for c in COUNTERS)
+            io_time = self.io_time
+            if since is not None:
+                commands = dict((verb, h.since(since.commands[verb]) if verb in since.commands else h)
+                                for verb, h in commands.items())
+                wait = wait.since(since.wait)
+                for c in COUNTERS:
+                    counters[c] -= getattr(since, c)
+                io_time -= since.io_time
+            snap = dict(
+                commands=dict((verb, h.stats()) for verb, h in commands.items() if h.count),
+                wait=wait.stats(),
+                io_time=io_time,
+                wait_time=wait.total)
+            snap.update(counters)
+            return snap
@@ -0,0 +1,131 @@
+'''
+Trapezoidal motion profile of an ASI LX-4000 axis.
+
+Units follow the controller settings exposed by ASIStageHW:
+distances in mm, SPEED in mm/s, AC (ramp time) in ms, backlash in mm.
+'''
+import math
+
+import numpy as np
+
+
+def ramp_time(acc_ms):
+    """AC setting in ms --> ramp time in seconds"""
+    return max(float(acc_ms), 0.0)*1e-3
+
+
+def trapezoid_duration(distance, speed, acc_ms):
+    """time (s) to travel distance (mm) from rest to rest.
+    The axis ramps linearly to speed in acc_ms, cruises, and ramps
+    back down. Short moves never reach full speed (triangular profile)"""
+    d = abs(distance)
+    if d == 0 or speed <= 0:
+        return 0.0
+    t_acc = ramp_time(acc_ms)
+    if t_acc == 0:
+        return d/speed
+    d_ramp = speed*t_acc # distance spent in both ramps
+    if d >= d_ramp:
+        return d/speed + t_acc
+    # triangular profile: accel = speed/t_acc
+    return 2*math.sqrt(d*t_acc/speed)
+
+
+def trapezoid_distance(distance, speed, acc_ms, t):
+    """signed distance (mm) travelled t seconds into a move of distance"""
+    d = abs(distance)
+    T = trapezoid_duration(d, speed, acc_ms)
+    if t <= 0 or d == 0:
+        return 0.0
+    if t >= T:
+        return distance
+    t_acc = ramp_time(acc_ms)
+    if t_acc == 0:
+        s = speed*t
+    else:
+        a = speed/t_acc
+        t_ramp = min(t_acc, T/2) # triangular profile peaks at T/2
+        v_peak = a*t_ramp
+        if t < t_ramp:
+            s = 0.5*a*t**2
+        elif t <= T - t_ramp:
+            s = 0.5*a*t_ramp**2 + v_peak*(t - t_ramp)
+        else:
+            s = d - 0.5*a*(T - t)**2
+    return math.copysign(min(s, d), distance)
+
+
+def move_legs(start, target, backlash=0.0):
+    """list of (start, end) legs the controller executes to reach target.
+    With anti-backlash enabled, moves in the negative direction overshoot
+    by backlash so the final approach is always in the positive direction"""
+    if backlash > 0 and target < start:
+        return [(start, target - backlash), (target - backlash, target)]
+    return [(start, target)]
+
+
+def move_duration(start, target, speed, acc_ms, backlash=0.0, settle=0.0):
+    """total time (s) for a move from start to target including
+    anti-backlash leg and a final settle time"""
+    if start == target:
+        return 0.0
+    T = sum(trapezoid_duration(b - a, speed, acc_ms)
+            for a, b in move_legs(start, target, backlash))
+    return T + settle
+
+
+class AxisMotion(object):
+    """
+    Time-stamped move of a single axis, evaluated analytically.
+    Positions in mm, times in seconds on the clock used to start the move.
+    """
+
+    def __init__(self, start, target, t0, speed, acc_ms, backlash=0.0, settle=0.0):
+        self.start = start
+        self.target = target
+        self.t0 = t0
+        self.settle = settle
+        self.legs = []
+        t = t0
+        for a, b in move_legs(start, target, backlash):
+            T = trapezoid_duration(b - a, speed, acc_ms)
+            self.legs.append((t, T, a, b, speed, acc_ms))
+            t += T
+        self.t_arrive = t
+        self.t_done = t + settle if start != target else t
+
+    def position(self, t):
+        if t >= self.t_arrive:
+            return self.target
+        for t_leg, T, a, b, speed, acc_ms in self.legs:
+            if t < t_leg + T:
+                return a + trapezoid_distance(b - a, speed, acc_ms, t - t_leg)
+        return self.target
+
+    def is_busy(self, t):
+        return t < self.t_done
+
+
+def move_durations(start, target, speed, acc_ms, backlash=0.0, settle=0.0):
+    """vectorized move_duration for NumPy arrays of start and target"""
+    start = np.asarray(start, dtype=float)
+    target = np.asarray(target, dtype=float)
+    d = target - start
+
+    def trapezoid(dist):
+        dist = np.abs(dist)
+        if speed <= 0:
+            return np.zeros_like(dist)
+        t_acc = ramp_time(acc_ms)
+        if t_acc == 0:
+            return dist/speed
+        return np.where(dist >= speed*t_acc,
+                        dist/speed + t_acc,
+                        2*np.sqrt(dist*t_acc/speed))
+
+    if backlash > 0:
+        # negative moves overshoot by backlash, then approach from below
+        T = np.where(d < 0, trapezoid(np.abs(d) + backlash) + trapezoid(backlash), trapezoid(d))
+    else:
+        T = trapezoid(d)
+    return np.where(d != 0, T + settle, 0.0)
@@ -1,18 +1,81 @@
 from ScopeFoundry import Measurement
 from ScopeFoundry.helper_funcs import load_qt_ui_file, sibling_path
 from collections import OrderedDict
+from qtpy import QtCore
 from qtpy.QtCore import Qt
 from qtpy.QtWidgets import QFileDialog
+import numpy as np
 import time
 import csv
 import os
 
+from .asi_stage_focus import FocusMap, FOCUS_MODELS
+from .asi_stage_route import plan_route
+from .asi_stage_spatial import GridIndex
+from .asi_stage_store import PositionStore, save_npz, load_npz, save_h5, load_h5
+
+# rows of this name in a saved list are focus points, not locations
+FOCUS_ROW = '#focus'
+
+
+class PositionListModel(QtCore.QAbstractListModel):
+    """names of the saved positions, with O(1) name -> row lookup"""
+
+    def __init__(self, parent=None):
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.names = []
+        self.rows = dict()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.names[index.row()]
+        return None
+
+    def name(self, row):
+        if 0 <= row < len(self.names):
+            return self.names[row]
+
+    def row(self, name):
+        return self.rows.get(name)
+
+    def set_names(self, names):
+        self.beginResetModel()
+        self.names = list(names)
+        self.rows = {name: k for k, name in enumerate(self.names)}
+        self.endResetModel()
+
+    def append(self, name):
+        n = len(self.names)
+        self.beginInsertRows(QtCore.QModelIndex(), n, n)
+        self.names.append(name)
+        self.rows[name] = n
+        self.endInsertRows()
+
+    def remove(self, name):
+        k = self.rows.pop(name)
+        self.beginRemoveRows(QtCore.QModelIndex(), k, k)
+        del self.names[k]
+        for j in range(k, len(self.names)):
+            self.rows[self.names[j]] = j
+        self.endRemoveRows()
+
 
 class ASIStagePositionList(Measurement):
     name = "asi_stage_position_list"
     
+    def __init__(self, app, name=None, hw_name='asi_stage'):
+        # hw_name: an ASIStageHW or an ASIStageGroupHW
+        self.hw_name = hw_name
+        Measurement.__init__(self, app, name=name)
+    
     def setup(self):
-        self.stage = self.app.hardware['asi_stage']
+        self.stage = self.app.hardware[self.hw_name]
+        # settings of the stage, or of the primary stage of a group
+        self.primary = getattr(self.stage, 'primary', self.stage)
+        self.stage_settings = self.primary.settings
         
         self.ui_filename = sibling_path(__file__,"asi_position_list.ui")
         self.ui = load_qt_ui_file(self.ui_filename)
@@ -21,12 +84,38 @@ class ASIStagePositionList(Measurement):
         self.display_update_period = 0.5 # seconds
         
         self.locations = OrderedDict()
+        self.model = PositionListModel()
+        # XY index of the saved sites (except 'previous')
+        self.index = GridIndex(cell=1.0)
+        # focus points shared by the tilt and 3D scans
+        self.focus_map = FocusMap()
         
         S = self.settings
         S.New('loc_name', dtype=str, ro=False)
         S.New('loc_x', dtype=float, ro=True, spinbox_decimals=4, unit='mm')
         S.New('loc_y', dtype=float, ro=True, spinbox_decimals=4, unit='mm')
         S.New('loc_z', dtype=float, ro=True, spinbox_decimals=4, unit='mm')
+        S.New('focus_model', dtype=str, initial='plane', choices=FOCUS_MODELS)
+        S.New('focus_smoothing', dtype=float, initial=0.0, vmin=0)
+        S.New('focus_points', dtype=int, initial=0, ro=True)
+        S.focus_model.add_listener(self.update_focus_model)
+        S.focus_smoothing.add_listener(self.update_focus_model)
+        # a new site closer than this to a saved one is reported as duplicate
+        S.New('duplicate_tolerance', dtype=float, initial=0.001, unit='mm', spinbox_decimals=4, vmin=0)
+        # route planning: start at this saved position ('' = current stage position)
+        S.New('route_start', dtype=str, initial='')
+        S.New('route_time_before', dtype=float, ro=True, unit='s', spinbox_decimals=1)
+        S.New('route_time_after', dtype=float, ro=True, unit='s', spinbox_decimals=1)
+        
+        # positions are kept in an SQLite file ('' = save_dir/asi_stage_positions.sqlite),
+        # separate lists per session
+        S.New('store_file', dtype=str, initial='')
+        S.New('session', dtype=str, initial='default')
+        S.New('export_format', dtype=str, initial='csv', choices=('csv', 'npz', 'h5'))
+        self.store = None
+        self.open_store()
+        S.store_file.add_listener(self.open_store)
+        S.session.add_listener(self.open_session)
         
         self.add_operation('go to saved pos', self.go_to_position)
         self.add_operation('go to prev pos', self.go_to_previous)
@@ -35,6 +124,10 @@ class ASIStagePositionList(Measurement):
         self.add_operation('load saved pos', self.load_position)
         self.add_operation('save previous position', self.save_previous)
         self.add_operation('delete position', self.delete_position)
+        self.add_operation('optimize route', self.optimize_route)
+        self.add_operation('snap to nearest saved pos', self.snap_to_nearest)
+        self.add_operation('mark focus point', self.mark_focus_point)
+        self.add_operation('clear focus points', self.clear_focus_points)
         
     def setup_figure(self):
         S = self.settings
@@ -45,9 +138,9 @@ class ASIStagePositionList(Measurement):
         S.loc_y.connect_to_widget(self.ui.saved_y_doubleSpinBox)
         S.loc_z.connect_to_widget(self.ui.saved_z_doubleSpinBox)
         
-        self.stage.settings.x_position.connect_to_widget(self.ui.x_doubleSpinBox)
-        self.stage.settings.y_position.connect_to_widget(self.ui.y_doubleSpinBox)
-        self.stage.settings.z_position.connect_to_widget(self.ui.z_doubleSpinBox)
+        self.stage_settings.x_position.connect_to_widget(self.ui.x_doubleSpinBox)
+        self.stage_settings.y_position.connect_to_widget(self.ui.y_doubleSpinBox)
+        self.stage_settings.z_position.connect_to_widget(self.ui.z_doubleSpinBox)
         
         self.ui.save_pushButton.clicked.connect(self.save_position)
         self.ui.halt_pushButton.clicked.connect(self.halt_stage)
@@ -60,87 +153,231 @@ class ASIStagePositionList(Measurement):
         self.ui.load_file_pushButton.clicked.connect(self.load_list)
         self.ui.save_file_pushButton.clicked.connect(self.save_list)
         
-        self.list = self.ui.position_listWidget
-        self.list.itemSelectionChanged.connect(self.load_position)
+        self.list = self.ui.position_listView
+        self.list.setModel(self.model)
+        self.list.selectionModel().currentChanged.connect(self.load_position)
+    
+    def open_store(self):
+        fname = self.settings['store_file']
+        if not fname:
+            save_dir = self.app.settings['save_dir']
+            if os.path.isdir(save_dir):
+                fname = os.path.join(save_dir, 'asi_stage_positions.sqlite')
+            else:
+                print('{}: no save_dir, positions are not kept on disk'.format(self.name))
+                fname = ':memory:'
+        if self.store is not None:
+            self.store.close()
+        self.store = PositionStore(fname, self.settings['session'])
+        self.reload_locations()
+        self.reload_focus_points()
+    
+    def open_session(self):
+        self.store.open_session(self.settings['session'])
+        self.reload_locations()
+        self.reload_focus_points()
+    
+    def reload_focus_points(self):
+        self.focus_map.set_points(self.store.focus_points())
+        self.settings['focus_points'] = len(self.focus_map)
     
-    def load_position(self, item=None):
-        item = self.list.currentItem()
-        loc = self.locations[item.text()]
-        self.settings.loc_name.update_value(item.text())
+    def reload_locations(self):
+        """refresh the list, dict and spatial index from the store"""
+        names, xyz = self.store.to_arrays()
+        self.locations = OrderedDict(zip(names, map(tuple, xyz.tolist())))
+        self.model.set_names(names)
+        self.index.rebuild((name, loc[0], loc[1]) for name, loc in self.locations.items()
+                           if name != 'previous')
+    
+    def current_name(self):
+        return self.model.name(self.list.currentIndex().row())
+    
+    def select(self, name):
+        row = self.model.row(name)
+        if row is not None:
+            self.list.setCurrentIndex(self.model.index(row))
+    
+    def load_position(self, *args):
+        name = self.current_name()
+        if name is None:
+            return
+        loc = self.locations[name]
+        self.settings.loc_name.update_value(name)
         self.settings.loc_x.update_value(loc[0])
         self.settings.loc_y.update_value(loc[1])
         self.settings.loc_z.update_value(loc[2])
         
     def delete_position(self):
-        item = self.list.currentItem()
-        self.delete_loc(item.text())
+        name = self.current_name()
+        if name is not None:
+            self.delete_loc(name)
     
     def halt_stage(self):
         self.stage.halt_xy()
         self.stage.halt_z()
         
     def add_loc(self, name):
-        if name not in list(self.locations.keys()):
-            self.list.addItem(name)
-        self.locations[name] = (self.stage.settings['x_position'],
-                                self.stage.settings['y_position'],
-                                self.stage.settings['z_position'])
+        loc = tuple(self.stage.get_position())
+        if name not in self.locations:
+            self.model.append(name)
+        self.locations[name] = loc
+        self.store.put(name, *loc[:3])
+        if name != 'previous':
+            for other in self.within(loc[0], loc[1], self.settings['duplicate_tolerance']):
+                if other != name:
+                    print('position {} duplicates {}'.format(name, other))
+            self.index.add(name, loc[0], loc[1])
     
     def delete_loc(self, name):
-        # self.list.removeItemWidget(items[0]) # doesn't work for some reason...
-        for kk in range(len(self.locations)):
-            if self.list.item(kk).text() == name:
-                self.list.takeItem(kk)
-                self.locations.pop(name)
-                return
+        if name not in self.locations:
+            return
+        self.locations.pop(name)
+        self.model.remove(name)
+        if name in self.index:
+            self.index.remove(name)
+        self.store.delete(name)
+    
+    def nearest(self, x, y, k=1):
+        """names of the k saved sites closest to (x, y)"""
+        return [name for d, name in self.index.nearest(x, y, k)]
+    
+    def within(self, x, y, radius):
+        """names of the saved sites within radius (mm) of (x, y)"""
+        return self.index.within(x, y, radius)
+    
+    def snap_to_nearest(self):
+        """select the saved site closest to the stage and move there"""
+        if not self.stage_settings['connected']:
+            return
+        x, y = self.stage.get_position()[:2]
+        names = self.nearest(x, y)
+        if not names:
+            return
+        self.select(names[0])
+        self.load_position()
+        self.go_to_position()
     
     def save_previous(self):
-        if self.stage.settings['connected']:
+        if self.stage_settings['connected']:
                 self.add_loc('previous')
     
     def save_position(self):
-        if self.stage.settings['connected']:
+        if self.stage_settings['connected']:
             self.add_loc(self.settings.loc_name.val)
     
+    def optimize_route(self):
+        """reorder the saved positions to minimize total travel time"""
+        names = [name for name in self.locations.keys() if name != 'previous']
+        if not names:
+            return
+        points = [self.locations[name] for name in names]
+        start = self.settings['route_start']
+        if start in names:
+            # pinned first site
+            k = names.index(start)
+            names.insert(0, names.pop(k))
+            points.insert(0, points.pop(k))
+        elif self.stage_settings['connected']:
+            # start from where the stage is now
+            names.insert(0, None)
+            points.insert(0, tuple(self.stage.get_position()))
+        
+        S = self.stage_settings
+        speeds = (S['speed_x'], S['speed_y'], S['speed_z'] if self.primary.enable_z else 1.0)
+        backlash = (S['backlash_xy'], S['backlash_xy'], S['backlash_z'] if self.primary.enable_z else 0.0)
+        order, t_before, t_after = plan_route(points, 0, speeds, S['acc_xy'], backlash)
+        self.settings['route_time_before'] = t_before
+        self.settings['route_time_after'] = t_after
+        print('route: {:.1f} s -> {:.1f} s'.format(t_before, t_after))
+        
+        ordered = [names[k] for k in order if names[k] is not None]
+        if 'previous' in self.locations:
+            ordered.append('previous')
+        self.locations = OrderedDict((name, self.locations[name]) for name in ordered)
+        self.model.set_names(ordered)
+        self.store.set_order(ordered)
+    
+    def update_focus_model(self):
+        self.focus_map.set_model(self.settings['focus_model'], self.settings['focus_smoothing'])
+    
+    def mark_focus_point(self):
+        """add the current (x, y, z) as an in-focus point"""
+        if self.stage_settings['connected']:
+            x, y, z = self.stage.get_position()
+            self.focus_map.add_point(x, y, z)
+            self.store.add_focus_point(x, y, z)
+            self.settings['focus_points'] = len(self.focus_map)
+    
+    def clear_focus_points(self):
+        self.focus_map.clear()
+        self.store.clear_focus_points()
+        self.settings['focus_points'] = 0
+    
     def go_to_position(self):
-        if self.stage.settings['connected']:
-            self.stage.move_x(self.settings.loc_x.val)
-            self.stage.move_y(self.settings.loc_y.val)
+        if self.stage_settings['connected']:
+            self.stage.move_xy(self.settings.loc_x.val, self.settings.loc_y.val)
             self.stage.move_z(self.settings.loc_z.val)
             
-            while self.stage.is_busy_xy() or self.stage.is_busy_z():
-                time.sleep(0.1)
+            self.stage.wait_until_not_busy_xyz()
             
     def go_to_previous(self):
-        items = self.list.findItems('previous', Qt.MatchExactly)
-        self.list.setCurrentItem(items[0])
-        self.location_selected(items[0])
+        self.select('previous')
+        self.load_position()
         self.go_to_position()
         
+    def saved_arrays(self):
+        """(names, xyz) of the saved positions, without 'previous'"""
+        names = [name for name in self.locations.keys() if name != 'previous']
+        xyz = np.array([self.locations[name][:3] for name in names], dtype=float).reshape(-1, 3)
+        return names, xyz
+    
     def save_list(self):
         t = time.localtime(time.time())
         t_string = "{:02d}{:02d}{:02d}_{:02d}{:02d}{:02d}".format(int(str(t[0])[2:4]), t[1], t[2], t[3], t[4], t[5])
         fname = os.path.join(self.app.settings['save_dir'], "%s_%s" % (t_string, self.name))
-        
-        with open(fname+'.csv', 'w', newline='') as listfile:
-            print('Saving position list to %s.csv' % fname)
-            w = csv.writer(listfile, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
-            w.writerow(['Location name', 'x (mm)', 'y (mm)', 'z (mm)'])
-            for key, val in self.locations.items():
-                print(key, val)
-                if key != 'previous':
-                    w.writerow([key, val[0], val[1], val[2]])
+        self.export_list(fname + '.' + self.settings['export_format'])
+    
+    def export_list(self, fname):
+        """write the saved positions and focus points to .csv, .npz or .h5"""
+        names, xyz = self.saved_arrays()
+        focus_points = self.focus_map.points
+        print('Saving {} positions to {}'.format(len(names), fname))
+        if fname.endswith('.npz'):
+            save_npz(fname, names, xyz, focus_points=focus_points)
+        elif fname.endswith('.h5'):
+            save_h5(fname, names, xyz, focus_points=focus_points)
+        else:
+            with open(fname, 'w', newline='') as listfile:
+                w = csv.writer(listfile, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+                w.writerow(['Location name', 'x (mm)', 'y (mm)', 'z (mm)'])
+                w.writerows([name, x, y, z] for name, (x, y, z) in zip(names, xyz.tolist()))
+                w.writerows([FOCUS_ROW, x, y, z] for x, y, z in focus_points.tolist())
         
     def load_list(self):
-        fname = QFileDialog.getOpenFileName(None, "Select location file...", self.app.settings['save_dir'], filter='csv (*.csv)')
+        fname = QFileDialog.getOpenFileName(None, "Select location file...", self.app.settings['save_dir'],
+                                            filter='position lists (*.csv *.npz *.h5)')
         if len(fname[0]) > 0:
-            with open(fname[0], newline='') as listfile:
-                print('Loading position list from ' + fname[0])
-                r = csv.reader(listfile, delimiter='\t')
-                for row in r:
-                    print(row[0])
-                    if row[0] != 'Location name':
-                        if row[0] not in list(self.locations.keys()):
-                            self.list.addItem(row[0])
-                        self.locations[row[0]] = (float(row[1]), float(row[2]), float(row[3]))
-    
\ No newline at end of file
+            self.import_list(fname[0])
+    
+    def import_list(self, fname):
+        """bulk load positions (and focus points) from .csv, .npz or .h5"""
+        print('Loading position list from ' + fname)
+        if fname.endswith('.npz'):
+            names, xyz, extra = load_npz(fname)
+            focus_points = extra.get('focus_points', [])
+        elif fname.endswith('.h5'):
+            names, xyz, extra = load_h5(fname)
+            focus_points = extra.get('focus_points', [])
+        else:
+            with open(fname, newline='') as listfile:
+                rows = [row for row in csv.reader(listfile, delimiter='\t')
+                        if row and row[0] != 'Location name']
+            focus_points = [[float(v) for v in row[1:4]] for row in rows if row[0] == FOCUS_ROW]
+            rows = [row for row in rows if row[0] != FOCUS_ROW]
+            names = [row[0] for row in rows]
+            xyz = np.array([row[1:4] for row in rows], dtype=float).reshape(-1, 3)
+        self.store.put_many(names, xyz)
+        self.reload_locations()
+        if len(focus_points):
+            self.store.set_focus_points(focus_points)
+            self.reload_focus_points()
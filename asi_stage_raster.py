@@ -1,11 +1,306 @@
 from ScopeFoundry.scanning import BaseRaster2DSlowScan, BaseRaster3DSlowScan
 import time
+import numpy as np
 
-class ASIStage2DScan(BaseRaster2DSlowScan):
+from .asi_stage_motion import ramp_time
+from .asi_stage_trajectory import RasterTrajectory, direction_offset, regrid_line
+
+
+class ASIStageScanMixin(object):
+    """
+    Stage handling shared by the ASI slow scans: the scan holds a motion
+    session (no background polling) and streams a RasterTrajectory
+    planned before the first move.
+    """
+    
+    # line starts are approached from pre_approach (mm) before h,
+    # against the line direction
+    pre_approach = 0.02
+    
+    # measurement holding the shared focus map
+    pos_list_name = 'asi_stage_position_list'
+    
+    # last Z commanded by the scan and whether it may still be moving
+    _z_sent = None
+    _z_moving = False
+    
+    # time (s) spent in move_line_start() and move_fast() this scan
+    _t_motion = 0.0
+
+    def bind_stage(self):
+        """self.stage = the ASIStageHW named hw_name. Scans drive a single
+        controller (transform, trajectory, ring buffer), not a group."""
+        stage = self.app.hardware[self.hw_name]
+        if hasattr(stage, 'member_names'):
+            raise ValueError("{}: hw_name '{}' is a stage group, scans need a single ASI stage".format(
+                self.name, self.hw_name))
+        self.stage = stage
+
+    def setup_stage_settings(self):
+        # step through each line from the controller's ring buffer: the
+        # targets of a line are uploaded in one batch during the flyback,
+        # each pixel is then a short '2HRM' step (still one round trip per
+        # pixel). Falls back to host-driven moves without firmware support
+        self.settings.New('ring_buffer', dtype=bool, initial=False)
+        # serpentine scans: after the scan, measure the shift between
+        # forward and reverse lines and update the stored offset
+        self.settings.New('calibrate_direction', dtype=bool, initial=False)
+        self.add_operation('calibrate_direction_offset', self.calibrate_direction_offset)
+
+    def pre_scan_setup(self):
+        # pause background polling while the scan owns the stage
+        self.stage.begin_motion_session()
+        self.start_scan_metrics()
+        self.attach_trajectory_recorder()
+        self.plan_trajectory()
+        self._ring_next = self._ring_end = -1
+        self._z_sent = None
+        self._z_moving = False
+        self._planned_target = None
+        self.use_ring_buffer = (self.trajectory is not None and self.settings['ring_buffer']
+                                and self.stage.ring_buffer_supported())
+
+    def post_scan_cleanup(self):
+        self.stage.end_motion_session()
+        if self._planned_target is not None:
+            self.track_target(*self._planned_target)
+        self.save_scan_metrics()
+        if getattr(self.stage, 'recorder', None) is not None:
+            self.stage.recorder.detach()
+        if self.settings['calibrate_direction'] and not self.interrupt_measurement_called:
+            self.calibrate_direction_offset()
+    
+    def stage_metrics(self):
+        """CommandMetrics of the driver, None if not available (e.g. a group)"""
+        return getattr(getattr(self.stage, 'stage', None), 'metrics', None)
+    
+    def start_scan_metrics(self):
+        self._t_scan = time.monotonic()
+        self._t_motion = 0.0
+        metrics = self.stage_metrics()
+        self._metrics_start = metrics.checkpoint() if metrics is not None else None
+    
+    def scan_metrics(self):
+        """where the time of the scan went: pixels/s and the fractions of
+        wall time spent moving (line starts and steps), waiting for the
+        stage (part of moving) and in serial I/O (polls during waits
+        included). Command latencies are those of this scan only."""
+        duration = time.monotonic() - self._t_scan
+        pixels = getattr(self, 'pixel_i', -1) + 1
+        summary = dict(pixels=pixels, duration=duration,
+                       pixels_per_s=pixels/duration if duration > 0 else 0.0,
+                       motion_fraction=self._t_motion/duration if duration > 0 else 0.0)
+        if self._metrics_start is not None:
+            snap = self.stage_metrics().snapshot(since=self._metrics_start)
+            summary.update(wait_fraction=snap['wait_time']/duration if duration > 0 else 0.0,
+                           io_fraction=snap['io_time']/duration if duration > 0 else 0.0,
+                           retries=snap['retries'], failures=snap['failures'],
+                           timeouts=snap['timeouts'], errors=snap['errors'])
+            return summary, snap['commands']
+        return summary, dict()
+    
+    def save_scan_metrics(self):
+        """print the scan metrics and write them to the 'stage_metrics'
+        group of the scan's HDF5 file: the summary as attributes, the
+        latencies by verb as a table (ms)"""
+        if not hasattr(self, '_t_scan'):
+            return
+        summary, commands = self.scan_metrics()
+        print('{}: {:.1f} pixels/s, motion {:.0%}, wait {:.0%}, I/O {:.0%}'.format(
+            self.name, summary['pixels_per_s'], summary['motion_fraction'],
+            summary.get('wait_fraction', 0.0), summary.get('io_fraction', 0.0)))
+        if not self.settings['save_h5']:
+            return
+        try:
+            group = self.h5_meas_group.create_group('stage_metrics')
+            for k, v in summary.items():
+                group.attrs[k] = v
+            fields = ('count', 'mean', 'p50', 'p90', 'p99', 'max')
+            table = np.zeros(len(commands), dtype=[('verb', 'S8')] + [(f, 'f8') for f in fields])
+            for row, verb in zip(table, sorted(commands)):
+                row['verb'] = verb.encode()
+                for f in fields:
+                    row[f] = commands[verb][f]
+            group['command_latency'] = table
+        except Exception as err:
+            # HDF5 file already closed
+            print('cannot save stage metrics:', err)
+    
+    def attach_trajectory_recorder(self):
+        """save the recorded stage trajectory of this scan to its HDF5 file"""
+        rec = getattr(self.stage, 'recorder', None)
+        # h5_meas_group is left over from an earlier scan when this one
+        # does not save
+        if rec is None or rec.thread is None or not self.settings['save_h5']:
+            return
+        rec.attach(self.h5_meas_group.create_group('stage_trajectory'))
+    
+    def setup_focus_settings(self, sources=('position_list',)):
+        """focus surface: from the focus points of the position list
+        (or a source of the scan itself)"""
+        self.settings.New('focus_source', dtype=str, initial=sources[0], choices=sources)
+        # Z is only moved when the focus correction changed by more than
+        # this, e.g. the depth of field
+        self.settings.New('z_tolerance', dtype=float, initial=0.002, unit='mm', spinbox_decimals=4, vmin=0)
+    
+    def get_focus_map(self):
+        if self.settings['focus_source'] == 'position_list':
+            return self.app.measurements[self.pos_list_name].focus_map
+        return self.focus_map
+    
+    def prepare_focus_map(self):
+        """cache the focus surface on a grid over the scan area"""
+        S = self.settings
+        fm = self.get_focus_map()
+        fm.build_grid(min(S['h0'], S['h1']), max(S['h0'], S['h1']),
+                      min(S['v0'], S['v1']), max(S['v0'], S['v1']))
+        return fm
+    
+    def move_z_focus(self, z):
+        """move Z unless it is within z_tolerance of the last Z sent.
+        Returns True if a Z command was issued."""
+        if self._z_sent is not None and abs(z - self._z_sent) <= self.settings['z_tolerance']:
+            return False
+        self.stage.move_z(z)
+        self._z_sent = z
+        self._z_moving = True
+        return True
+    
+    def scan_speed(self):
+        """speed (mm/s) the direction offset is calibrated for"""
+        return self.stage.settings['speed_xy']
+    
+    def plan_trajectory(self):
+        """work out every move of the scan up front"""
+        if hasattr(self, 'scan_slow_move'):
+            self.trajectory = RasterTrajectory.from_scan(
+                self, self.stage, self.pre_approach,
+                reverse_offset=self.stage.get_direction_offset(self.scan_speed()))
+        else:
+            self.trajectory = None
+    
+    def calibrate_direction_offset(self):
+        """cross-correlate forward and reverse lines of the last
+        serpentine scan and add the residual shift to the stored offset
+        for the current scan speed"""
+        T = getattr(self, 'trajectory', None)
+        if T is None or not np.any(T.direction < 0):
+            print('calibrate_direction_offset: no serpentine scan data')
+            return
+        k, j = self.scan_index_array[T.slow_move, :2].T
+        line_dir = T.direction[T.slow_move]
+        img = self.display_image_map
+        fwd = img[k[line_dir > 0], j[line_dir > 0]]
+        rev = img[k[line_dir < 0], j[line_dir < 0]]
+        residual = direction_offset(fwd, rev, self.settings['dh'])
+        offset = T.reverse_offset + residual
+        self.stage.set_direction_offset(self.scan_speed(), offset)
+        print('direction offset at {:.3f} mm/s: {:.5f} mm (residual {:.5f} mm)'.format(
+            self.scan_speed(), offset, residual))
+    
+    def planned_index(self, h, v):
+        """index of the current pixel in the trajectory, None if unplanned"""
+        T = getattr(self, 'trajectory', None)
+        i = getattr(self, 'pixel_i', -1)
+        if T is not None and T.matches(i, h, v):
+            return i
+    
+    def track_target(self, h, v):
+        """planned moves go to stage coordinates directly: keep x_target
+        and y_target (sample coordinates) in step without moving again"""
+        S = self.stage.settings
+        S.x_target.update_value(h, update_hardware=False)
+        S.y_target.update_value(v, update_hardware=False)
+        self._planned_target = None
+    
+    def move_line_start(self, h, v):
+        """fly to the pre-approach point, then approach (h, v)"""
+        t0 = time.monotonic()
+        try:
+            i = self.planned_index(h, v)
+            if i is None:
+                self.stage.set_xy_target(h-self.pre_approach, v)
+                self.stage.wait_until_not_busy_xy()
+                self.stage.settings["x_target"] = h
+                self.wait_until_settled()
+                return
+            T = self.trajectory
+            self.stage.move_stage_xy(T.approach_x[i], T.approach_y[i])
+            if self.use_ring_buffer:
+                # upload the rest of the line while flying back
+                self.load_ring_buffer(i+1)
+            self.stage.wait_until_not_busy_xy()
+            self.stage.move_stage_xy(T.stage_x[i], T.stage_y[i])
+            self.track_target(h, v)
+            self.wait_until_settled()
+        finally:
+            self._t_motion += time.monotonic() - t0
+    
+    def wait_until_settled(self):
+        """wait for XY and, if a Z move is in flight, for Z as well:
+        both cards are polled together, then Z is checked to be within
+        z_tolerance of its target"""
+        if not self._z_moving:
+            self.stage.wait_until_not_busy_xy()
+            return
+        self.stage.wait_until_not_busy_xyz()
+        self._z_moving = False
+        self.check_z_settled()
+    
+    def check_z_settled(self, timeout=0.5):
+        """poll Z until within z_tolerance of the last Z sent"""
+        t0 = time.monotonic()
+        while True:
+            z = self.stage.read_pos_z()
+            if z is not None and abs(z - self._z_sent) <= self.settings['z_tolerance']:
+                return True
+            if time.monotonic() - t0 > timeout:
+                print('Z not settled: {} mm, target {:.4f} mm'.format(z, self._z_sent))
+                return False
+            time.sleep(0.005)
+    
+    def load_ring_buffer(self, i):
+        """upload stage targets of pixels i.. (up to the end of the line)"""
+        T = self.trajectory
+        end = min(T.line_end[min(i, T.N-1)], i + self.stage.ring_buffer_size())
+        if i >= end:
+            return
+        self.stage.ring_buffer_load(T.stage_x[i:end], T.stage_y[i:end])
+        self._ring_next, self._ring_end = i, end
+    
+    def move_fast(self, h, v, dh):
+        # move without explicitely waiting for stage to finish
+        # otherwise the internal PID settings of the stage limits the pixel speed 
+        t0 = time.monotonic()
+        try:
+            i = self.planned_index(h, v)
+            if i is None:
+                self.stage.settings["x_target"] = h
+                time.sleep(1.2*abs(dh) / self.stage.settings['speed_xy'])
+                return
+            T = self.trajectory
+            self._planned_target = (h, v)
+            if self.use_ring_buffer:
+                if i == self._ring_end:
+                    # line is longer than the buffer
+                    self.load_ring_buffer(i)
+                if i == self._ring_next and i < self._ring_end:
+                    self.stage.ring_buffer_step()
+                    self._ring_next += 1
+                    time.sleep(T.step_wait[i])
+                    return
+            self.stage.move_stage_xy(T.stage_x[i], T.stage_y[i])
+            time.sleep(T.step_wait[i])
+        finally:
+            self._t_motion += time.monotonic() - t0
+
+
+class ASIStage2DScan(ASIStageScanMixin, BaseRaster2DSlowScan):
 
     name = 'asi_stage_raster'
     
-    def __init__(self, app):
+    def __init__(self, app, hw_name='asi_stage'):
+        self.hw_name = hw_name
         BaseRaster2DSlowScan.__init__(self, app, 
                                       h_limits=(-37,37), v_limits=(-23,37),
                                       #h_limits=(-15,15), v_limits=(-15,15),
@@ -14,7 +309,8 @@ class ASIStage2DScan(BaseRaster2DSlowScan):
 
     def setup(self):
         BaseRaster2DSlowScan.setup(self)
-        self.stage = self.app.hardware['asi_stage']
+        self.bind_stage()
+        self.setup_stage_settings()
 
     def new_pt_pos(self, x,y):
         # overwrite the function that lets you drag and drop the position
@@ -24,11 +320,9 @@ class ASIStage2DScan(BaseRaster2DSlowScan):
         try:
             if not self.stage.settings['connected']:
                 raise IOError("Not connected to ASI stage")
-            S["x_target"] = x
-            S["y_target"] = y
-            while self.stage.is_busy_xy():
-                time.sleep(0.03)
-            self.stage.correct_backlash(0.02)
+            self.stage.set_xy_target(x, y)
+            self.stage.wait_until_not_busy_xy()
+            self.stage.correct_backlash(self.pre_approach)
         finally:
             self.stage.other_observer = False
             
@@ -56,32 +350,18 @@ class ASIStage2DScan(BaseRaster2DSlowScan):
             
     def move_position_start(self, h,v):
         print('start scan, moving to x={:.4f} , y={:.4f} '.format(h,v))
-        self.stage.settings["x_target"] = h
-        self.stage.settings["y_target"] = v
+        self.stage.set_xy_target(h, v)
         #self.stage.move_x(h)
         #self.stage.move_y(v)
-        while self.stage.is_busy_xy():
-                time.sleep(0.03)
-        self.stage.correct_backlash(0.02)
+        self.stage.wait_until_not_busy_xy()
+        self.stage.correct_backlash(self.pre_approach)
         
     def move_position_slow(self, h,v,dh,dv):   
         print('new line, moving to x={:.4f} , y={:.4f} '.format(h,v))
-        self.stage.settings["x_target"] = h-0.02
-        self.stage.settings["y_target"] = v
-        #self.stage.move_y(v)
-        #self.stage.move_x(h-0.02)
-        while self.stage.is_busy_xy():
-                time.sleep(0.03)
-        #self.stage.move_x(h)
-        self.stage.settings["x_target"] = h
-        while self.stage.is_busy_xy():
-                time.sleep(0.03)
+        self.move_line_start(h, v)
 
     def move_position_fast(self, h,v,dh,dv):
-        # move without explicitely waiting for stage to finish
-        # otherwise the internal PID settings of the stage limits the pixel speed 
-        self.stage.settings["x_target"] = h
-        time.sleep(1.2*abs(dh) / self.stage.settings['speed_xy'])
+        self.move_fast(h, v, dh)
         
                 
 class ASIStageDelay2DScan(ASIStage2DScan):
@@ -103,18 +383,157 @@ class ASIStageDelay2DScan(ASIStage2DScan):
         pass
     
     
-class ASIStage3DScan(BaseRaster3DSlowScan):
+class ASIStageFly2DScan(ASIStage2DScan):
+    """
+    Continuous fast-axis scan: the stage crosses each line at constant
+    fly_speed while collect_fly_sample() is called as fast as it returns.
+    Every sample is tagged with time.monotonic(); the stage position is
+    read back every encoder_interval. After the line the samples are
+    regridded onto h_array and collect_pixel() only reads the result.
+    
+    Subclasses override collect_fly_sample() to read their detector.
+    """
+
+    name = 'asi_stage_fly_raster'
+    
+    def setup(self):
+        ASIStage2DScan.setup(self)
+        self.settings.New('fly_speed', dtype=float, initial=5.0, vmin=0.001, vmax=7.5, unit='mm/s')
+        self.settings.New('encoder_interval', dtype=float, initial=0.020, vmin=0.0, unit='s')
+    
+    def pre_scan_setup(self):
+        ASIStage2DScan.pre_scan_setup(self)
+        self.use_ring_buffer = False
+        self.line_data = np.full(len(self.h_array), np.nan)
+        # sample buffers, reused for every line
+        self._fly_t = np.zeros(4096)
+        self._fly_val = np.zeros(4096)
+    
+    def scan_speed(self):
+        return self.settings['fly_speed']
+    
+    def collect_fly_sample(self):
+        """override: one detector reading, taken while the stage moves"""
+        return 0.0
+    
+    def move_position_slow(self, h, v, dh, dv):
+        print('new line, flying across y={:.4f} '.format(v))
+        self.fly_line(h, v)
+    
+    def move_position_fast(self, h, v, dh, dv):
+        # stage has already crossed the line
+        pass
+    
+    def collect_pixel(self, pixel_num, k, j, i):
+        self.display_image_map[k, j, i] = self.line_data[i]
+    
+    def line_end_h(self, h, v):
+        """h of the last pixel of the line starting at (h, v)"""
+        i = self.planned_index(h, v)
+        if i is not None:
+            T = self.trajectory
+            return T.h[T.line_end[i]-1]
+        H = self.h_array
+        return H[-1] if abs(h - H[0]) <= abs(h - H[-1]) else H[0]
+    
+    def fly_line(self, h, v):
+        S = self.stage.settings
+        speed = self.settings['fly_speed']
+        h_end = self.line_end_h(h, v)
+        direction = 1.0 if h_end >= h else -1.0
+        offset = 0.0
+        if direction < 0 and getattr(self, 'trajectory', None) is not None:
+            offset = self.trajectory.reverse_offset
+        # ramp up/down outside the line, with a margin
+        ramp = 2.0*speed*ramp_time(S['acc_xy']) + self.pre_approach
+        
+        # approach the ramp start from the scan direction at normal speed
+        h_ramp = h - direction*ramp
+        self.stage.set_xy_target(h_ramp - direction*self.pre_approach, v)
+        self.stage.wait_until_not_busy_xy()
+        self.stage.set_xy_target(h_ramp, v)
+        self.stage.wait_until_not_busy_xy()
+        
+        dev = self.stage.stage
+        dev.set_speed_xy(speed, speed)
+        try:
+            t_enc, h_enc, t_s, vals = self.acquire_fly_line(h_ramp, h_end + direction*ramp, v,
+                                                             h_end, direction, speed)
+        finally:
+            dev.set_speed_xy(S['speed_x'], S['speed_y'])
+        self.stage.wait_until_not_busy_xy()
+        
+        if len(t_enc) < 2:
+            self.line_data[:] = np.nan
+            return
+        # reverse lines: the value of pixel h was read at h + offset
+        self.line_data = regrid_line(t_s, vals, t_enc, h_enc, self.h_array + offset)
+    
+    def acquire_fly_line(self, h_start, h_stop, v, h_end, direction, speed):
+        """issue the constant velocity move and sample until the stage
+        is past h_end. returns (t_encoder, h_encoder, t_samples, values)"""
+        t_buf, val_buf = self._fly_t, self._fly_val
+        n = 0
+        interval = self.settings['encoder_interval']
+        timeout = abs(h_stop - h_start)/speed + 1.0
+        
+        # stage rests at h_start until the move is issued
+        enc = [(time.monotonic(), h_start)]
+        self.stage.set_xy_target(h_stop, v)
+        t_start = t_next_enc = time.monotonic()
+        while not self.interrupt_measurement_called:
+            now = time.monotonic()
+            if now >= t_next_enc:
+                pos = self.stage.read_pos_xy()
+                t1 = time.monotonic()
+                t_next_enc = t1 + interval
+                if pos is not None:
+                    # position was latched around the middle of the query
+                    enc.append((0.5*(now + t1), pos[0]))
+                    if direction*(pos[0] - h_end) >= 0:
+                        break
+                if t1 - t_start > timeout:
+                    print('fly line timed out')
+                    break
+            if n == len(t_buf):
+                t_buf = np.concatenate([t_buf, np.zeros(n)])
+                val_buf = np.concatenate([val_buf, np.zeros(n)])
+            t0 = time.monotonic()
+            val_buf[n] = self.collect_fly_sample()
+            t_buf[n] = 0.5*(t0 + time.monotonic())
+            n += 1
+        self._fly_t, self._fly_val = t_buf, val_buf
+        
+        t_enc, h_enc = np.array(enc).T
+        return t_enc, h_enc, t_buf[:n], val_buf[:n]
+    
+    
+class ASIStage3DScan(ASIStageScanMixin, BaseRaster3DSlowScan):
 
     name = 'asi_stage_raster'
     
-    def __init__(self, app):
+    def __init__(self, app, hw_name='asi_stage'):
+        self.hw_name = hw_name
         BaseRaster3DSlowScan.__init__(self, app, h_limits=(-15,15), v_limits=(-15,15), z_limits=(-8,0),
                                       h_spinbox_step = 0.010, v_spinbox_step=0.010, z_spinbox_step=0.010,
                                       h_unit="mm", v_unit="mm", z_unit='mm', circ_roi_size=0.002)
 
     def setup(self):
         BaseRaster3DSlowScan.setup(self)
-        self.stage = self.app.hardware['asi_stage']
+        self.bind_stage()
+        self.setup_stage_settings()
+        # follow the focus surface: z of the scan is then an offset from it
+        self.settings.New('focus_correction', dtype=bool, initial=False)
+        self.setup_focus_settings()
+        self._frame_z = 0.0
+    
+    def pre_scan_setup(self):
+        ASIStageScanMixin.pre_scan_setup(self)
+        if self.settings['focus_correction']:
+            self.focus = self.prepare_focus_map()
+    
+    def focus_z(self, h, v):
+        return self.focus.z(h, v) + self._frame_z
 
     def new_pt_pos(self, x,y):
         # overwrite the function that lets you drag and drop the position
@@ -124,11 +543,9 @@ class ASIStage3DScan(BaseRaster3DSlowScan):
         try:
             if not self.stage.settings['connected']:
                 raise IOError("Not connected to ASI stage")
-            S["x_target"] = x
-            S["y_target"] = y
-            while self.stage.is_busy_xy():
-                time.sleep(0.03)
-            self.stage.correct_backlash(0.02)
+            self.stage.set_xy_target(x, y)
+            self.stage.wait_until_not_busy_xy()
+            self.stage.correct_backlash(self.pre_approach)
         finally:
             self.stage.other_observer = False
             
@@ -156,31 +573,26 @@ class ASIStage3DScan(BaseRaster3DSlowScan):
             
     def move_position_start(self, h, v, z):
         print('new frame, moving to x={:.4f} , y={:.4f}, z={:.4f}'.format(h,v,z))
-        self.stage.settings["x_target"] = h
-        self.stage.settings["y_target"] = v
+        self.stage.set_xy_target(h, v)
+        self._frame_z = z
+        if self.settings['focus_correction']:
+            z = self.focus_z(h, v)
+            self._z_sent = z
         self.stage.settings["z_target"] = z
         #self.stage.move_x(h)
         #self.stage.move_y(v)
-        while self.stage.is_busy_xy() or self.stage.is_busy_z():
-                time.sleep(0.03)
-        self.stage.correct_backlash(0.02)
+        self.stage.wait_until_not_busy_xyz()
+        self.stage.correct_backlash(self.pre_approach)
         
     def move_position_slow(self, h, v, dh, dv):   
         print('new line, moving to x={:.4f} , y={:.4f} '.format(h,v))
-        self.stage.settings["x_target"] = h-0.02
-        self.stage.settings["y_target"] = v
-        #self.stage.move_y(v)
-        #self.stage.move_x(h-0.02)
-        while self.stage.is_busy_xy():
-                time.sleep(0.03)
-        #self.stage.move_x(h)
-        self.stage.settings["x_target"] = h
-        while self.stage.is_busy_xy():
-                time.sleep(0.03)
+        if self.settings['focus_correction']:
+            # Z moves while XY flies back to the line start
+            self.move_z_focus(self.focus_z(h, v))
+        self.move_line_start(h, v)
 
     def move_position_fast(self, h,v,dh,dv):
-        # move without explicitely waiting for stage to finish
-        # otherwise the internal PID settings of the stage limits the pixel speed 
-        self.stage.settings["x_target"] = h
-        time.sleep(1.2*abs(dh) / self.stage.settings['speed_xy'])    
+        if self.settings['focus_correction']:
+            self.move_z_focus(self.focus_z(h, v))
+        self.move_fast(h, v, dh)
         
\ No newline at end of file
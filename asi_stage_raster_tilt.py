@@ -2,11 +2,15 @@ from ScopeFoundry.scanning import BaseRaster2DSlowScan
 import time
 import numpy as np
 
-class ASIStage2DScanTilt(BaseRaster2DSlowScan):
+from .asi_stage_raster import ASIStageScanMixin
+from .asi_stage_focus import FocusMap
+
+class ASIStage2DScanTilt(ASIStageScanMixin, BaseRaster2DSlowScan):
 
     name = 'asi_stage_raster'
     
-    def __init__(self, app):
+    def __init__(self, app, hw_name='asi_stage'):
+        self.hw_name = hw_name
         BaseRaster2DSlowScan.__init__(self, app, 
                                       h_limits=(-37,37), v_limits=(-23,37),
                                       #h_limits=(-15,15), v_limits=(-15,15),
@@ -15,12 +19,21 @@ class ASIStage2DScanTilt(BaseRaster2DSlowScan):
 
     def setup(self):
         BaseRaster2DSlowScan.setup(self)
-        self.stage = self.app.hardware['asi_stage']
+        self.bind_stage()
+        self.setup_stage_settings()
 
         self.settings.New('tilt_correction', dtype=bool)
+        # focus plane through tilt_point1..3, or the focus points of the
+        # position list
+        self.setup_focus_settings(('tilt_points', 'position_list'))
         self.settings.New('tilt_point1', dtype=float, array=True, initial=[0,0,0])
         self.settings.New('tilt_point2', dtype=float, array=True, initial=[0,0,0])
         self.settings.New('tilt_point3', dtype=float, array=True, initial=[0,0,0])
+        # also rebuilds the plane when the points are restored from saved settings
+        self.settings.tilt_point1.add_listener(self.compute_tilt_plane)
+        self.settings.tilt_point2.add_listener(self.compute_tilt_plane)
+        self.settings.tilt_point3.add_listener(self.compute_tilt_plane)
+        self.compute_tilt_plane()
         
         self.add_operation('Mark Focus 1', self.mark_tilt_point1)
         self.add_operation('Mark Focus 2', self.mark_tilt_point2)
@@ -38,14 +51,12 @@ class ASIStage2DScanTilt(BaseRaster2DSlowScan):
         try:
             if not self.stage.settings['connected']:
                 raise IOError("Not connected to ASI stage")
-            S["x_target"] = x
-            S["y_target"] = y
-            while self.stage.is_busy_xy():
-                time.sleep(0.03)
+            self.stage.set_xy_target(x, y)
+            self.stage.wait_until_not_busy_xy()
             if self.settings['tilt_correction']:
                 self.stage.settings['speed_z'] = 1.0
                 self.move_z_tilt()
-            self.stage.correct_backlash(0.02)
+            self.stage.correct_backlash(self.pre_approach)
 
         finally:
             self.stage.other_observer = False
@@ -72,96 +83,94 @@ class ASIStage2DScanTilt(BaseRaster2DSlowScan):
     #   finally:
     #       self.stage.other_observer = False
             
+    def pre_scan_setup(self):
+        ASIStageScanMixin.pre_scan_setup(self)
+        self.z_map = None
+        self._z_sent = None
+        if self.settings['tilt_correction']:
+            self.plan_z_map()
+    
+    def plan_z_map(self):
+        """focus Z of every pixel of the scan, in scan order"""
+        self.prepare_focus_map()
+        z_map = self.compute_z_tilt(self.scan_h_positions, self.scan_v_positions)
+        z = self.get_stage_pos_xyz()[2]
+        dz = np.max(np.abs(z_map - z))
+        if dz >= 2:
+            raise ValueError(f"tilt correction moves too far. current {z=} mm; max delta {dz} mm")
+        self.z_map = z_map
+    
+    def move_z_planned(self, h, v):
+        """move Z to the planned focus of the current pixel if it differs
+        by more than z_tolerance from the last Z sent. Returns True if a
+        Z command was issued."""
+        i = self.planned_index(h, v)
+        if self.z_map is None or i is None:
+            self.move_z_tilt()
+            self._z_sent = self.stage.settings['z_target']
+            self._z_moving = True
+            return True
+        return self.move_z_focus(self.z_map[i])
+    
     def move_position_start(self, h,v):
         print('start scan, moving to x={:.4f} , y={:.4f} '.format(h,v))
-        self.stage.settings["x_target"] = h
-        self.stage.settings["y_target"] = v
+        if self.settings['tilt_correction']:
+            # once per scan, not every line
+            if self.stage.settings['speed_z'] != 1.0:
+                self.stage.settings['speed_z'] = 1.0
+            # Z moves while XY travels to the start
+            self.move_z_focus(self.compute_z_tilt(h, v))
+        self.stage.set_xy_target(h, v)
         #self.stage.move_x(h)
         #self.stage.move_y(v)
-        while self.stage.is_busy_xy():
-                time.sleep(0.03)
-        self.stage.correct_backlash(0.02)
-        if self.settings['tilt_correction']:
-            self.stage.settings['speed_z'] = 1.0
-            self.move_z_tilt()
-            time.sleep(0.3)        
+        self.wait_until_settled()
+        self.stage.correct_backlash(self.pre_approach)
         
     def move_position_slow(self, h,v,dh,dv):   
         print('new line, moving to x={:.4f} , y={:.4f} '.format(h,v))
-        self.stage.settings["x_target"] = h-0.02
-        self.stage.settings["y_target"] = v
-        #self.stage.move_y(v)
-        #self.stage.move_x(h-0.02)
-        while self.stage.is_busy_xy():
-                time.sleep(0.03)
-        #self.stage.move_x(h)
-        self.stage.settings["x_target"] = h
-        while self.stage.is_busy_xy():
-                time.sleep(0.03)
         if self.settings['tilt_correction']:
-            self.stage.settings['speed_z'] = 1.0
-            self.move_z_tilt()
-            time.sleep(0.3)
+            # Z moves while XY flies back to the line start
+            self.move_z_planned(h, v)
+        self.move_line_start(h, v)
             
     def move_position_fast(self, h,v,dh,dv):
-        # move without explicitely waiting for stage to finish
-        # otherwise the internal PID settings of the stage limits the pixel speed 
         if self.settings['tilt_correction']:
-            self.move_z_tilt()
-            time.sleep(0.01)
-        self.stage.settings["x_target"] = h
-        time.sleep(1.2*abs(dh) / self.stage.settings['speed_xy'])
+            if self.move_z_planned(h, v):
+                time.sleep(0.01)
+        self.move_fast(h, v, dh)
 
     def get_stage_pos_xyz(self):
-        x = self.stage.settings['x_position']
-        y = self.stage.settings['y_position']
-        z = self.stage.settings['z_position']
+        x, y, z = self.stage.get_position()
         return (x,y,z)
 
     def compute_tilt_plane(self):
         p1 = self.settings['tilt_point1']
         p2 = self.settings['tilt_point2']
         p3 = self.settings['tilt_point3']
-        tilt_coords = np.array([p1,p2,p3])
-        flat_coords = tilt_coords.copy()
-        flat_coords[:,2] = 0 # set z=0 for flat plane coords
-        
-        import skimage.transform
-        tf = skimage.transform.estimate_transform(
-            'similarity', flat_coords, tilt_coords)
-        self.tilt_transform = tf
+        self.focus_map = FocusMap([p1,p2,p3], model='plane')
 
     def mark_tilt_point1(self):
         self.settings['tilt_point1'] = self.get_stage_pos_xyz()
         print(self.get_stage_pos_xyz())
-        self.compute_tilt_plane()
 
     def mark_tilt_point2(self):
         self.settings['tilt_point2'] = self.get_stage_pos_xyz()
-        self.compute_tilt_plane()
 
     def mark_tilt_point3(self):
         self.settings['tilt_point3'] = self.get_stage_pos_xyz()
-        self.compute_tilt_plane()
         
     def move_z_tilt(self):
-        print("move_z_tilt")
-        tf = self.tilt_transform
         x,y,z = self.get_stage_pos_xyz()
-        
-        x1,y1,z1,_ = tf.params @ [x,y,0,1]
-        print("move_z_tilt", x,y,z, "-->", x1,y1,z1)
-        
-        print(f"{z=} {z1=}")
+        z1 = self.compute_z_tilt(x, y)
+        print("move_z_tilt", x,y,z, "-->", z1)
         if abs(z1-z) < 2:
             self.stage.settings['z_target'] = z1
         else:
             raise ValueError(f"move_z_tilt moved too far. current {z=} mm; computed {z1=} mm; delta {z1-z} mm")
             
     def compute_z_tilt(self, x,y):
-        tf = self.tilt_transform        
-        x1,y1,z1,_ = tf.params @ [x,y,0,1]
-        return z1
+        """focus z at (x, y); scalars or arrays"""
+        return self.get_focus_map().z(x, y)
     
 class ASIStageDelay2DScanTilt(ASIStage2DScanTilt):
 
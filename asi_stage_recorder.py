@@ -0,0 +1,169 @@
+'''
+Background recorder of the actual stage trajectory.
+
+Samples (t, x, y, z, busy) at a fixed rate into a preallocated NumPy
+structured ring buffer. Memory use is fixed by the buffer size: when
+the buffer is not flushed in time the oldest samples are overwritten
+and counted as dropped.
+
+Each sample is one job at PRIORITY_POLL on the controller's I/O worker,
+so moves, halts and config commands always go first and a sample that
+is still queued is not queued twice (coalesced by key).
+
+    t     monotonic time (s), middle of the position query
+    busy  bit 0: XY card busy, bit 1: Z card busy
+
+flush() appends the unflushed samples to chunked, gzip compressed
+datasets in an HDF5 group (one resizable dataset per field).
+'''
+import threading
+import time
+
+import numpy as np
+
+from .asi_stage_io import PRIORITY_POLL
+
+TRAJECTORY_DTYPE = np.dtype([('t', 'f8'), ('x', 'f8'), ('y', 'f8'), ('z', 'f8'), ('busy', 'u1')])
+
+
+class StageTrajectoryRecorder(object):
+
+    def __init__(self, read_func, io, rate=20.0, size=100000, chunk=4096):
+        """
+        read_func: returns (x, y, z, busy) or raises; runs on the I/O thread
+        io: ASIStageIOWorker the samples are submitted to
+        rate: samples per second
+        size: ring buffer length (samples)
+        """
+        self.read_func = read_func
+        self.io = io
+        self.rate = rate
+        self.chunk = chunk
+        self.buffer = np.zeros(size, dtype=TRAJECTORY_DTYPE)
+        self.size = size
+        self.count = 0   # samples written since start
+        self.flushed = 0 # samples written to HDF5 (or skipped as dropped)
+        self.dropped = 0
+        self.errors = 0
+        self.write_errors = 0
+        self.lock = threading.Lock()
+        # held across a whole HDF5 write, so flushes from the recorder
+        # thread and detach() do not interleave
+        self.flush_lock = threading.Lock()
+        self.h5_group = None
+        self.flush_interval = 1.0 # s
+        self._stop = threading.Event()
+        self.thread = None
+        # monotonic -> epoch time offset, stored with the data
+        self.t_epoch_offset = time.time() - time.monotonic()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self._stop.clear()
+        self.thread = threading.Thread(target=self.run, name='asi_stage_recorder', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=1.0):
+        thread = self.thread
+        if thread is None:
+            return
+        self._stop.set()
+        thread.join(timeout)
+        self.thread = None
+
+    def run(self):
+        try:
+            t_next = t_flush = time.monotonic()
+            while not self._stop.is_set():
+                interval = 1.0/self.rate
+                self.io.submit(PRIORITY_POLL, self.sample, key='trajectory_sample')
+                now = time.monotonic()
+                # fixed schedule; ticks missed while the link was busy are skipped
+                t_next = max(t_next + interval, now)
+                if self.h5_group is not None and now - t_flush >= self.flush_interval:
+                    try:
+                        self.flush()
+                    except Exception as err:
+                        self.write_errors += 1
+                        print('trajectory recorder: cannot write samples:', err)
+                    t_flush = now
+                self._stop.wait(max(t_next - time.monotonic(), 0.0))
+        finally:
+            # lets start() run a new thread
+            if self.thread is threading.current_thread():
+                self.thread = None
+
+    def sample(self):
+        """read the stage once and store the sample (I/O thread)"""
+        t0 = time.monotonic()
+        try:
+            x, y, z, busy = self.read_func()
+        except Exception:
+            self.errors += 1
+            return
+        t = 0.5*(t0 + time.monotonic())
+        with self.lock:
+            self.buffer[self.count % self.size] = (t, x, y, z, busy)
+            self.count += 1
+
+    def snapshot(self, n=None):
+        """copy of the last n samples (default: all in the buffer), oldest first"""
+        with self.lock:
+            count = self.count
+            n = min(count, self.size) if n is None else min(n, count, self.size)
+            idx = np.arange(count - n, count) % self.size
+            return self.buffer[idx]
+
+    def attach(self, h5_group, flush_interval=1.0):
+        """flush new samples to h5_group every flush_interval seconds,
+        starting with the samples recorded from now on"""
+        with self.lock:
+            self.flushed = self.count
+        self.dropped = 0
+        self.flush_interval = flush_interval
+        self.h5_group = h5_group
+
+    def detach(self):
+        """final flush, then stop writing to the attached group"""
+        with self.flush_lock:
+            try:
+                if self.h5_group is not None:
+                    self._write(self.h5_group)
+            finally:
+                self.h5_group = None
+
+    def flush(self):
+        """append unflushed samples to the attached HDF5 group"""
+        with self.flush_lock:
+            if self.h5_group is None:
+                return 0
+            return self._write(self.h5_group)
+
+    def _write(self, group):
+        with self.lock:
+            count = self.count
+            start = self.flushed
+            if count - start > self.size:
+                # overwritten before they could be flushed
+                self.dropped += count - start - self.size
+                start = count - self.size
+            idx = np.arange(start, count) % self.size
+            data = self.buffer[idx]
+            self.flushed = count
+        n = len(data)
+        for name in TRAJECTORY_DTYPE.names:
+            if name not in group:
+                group.create_dataset(name, shape=(0,), maxshape=(None,),
+                                     dtype=TRAJECTORY_DTYPE[name],
+                                     chunks=(self.chunk,), compression='gzip', shuffle=True)
+            ds = group[name]
+            if n:
+                ds.resize((ds.shape[0] + n,))
+                ds[-n:] = data[name]
+        group.attrs['rate'] = self.rate
+        group.attrs['dropped'] = self.dropped
+        group.attrs['errors'] = self.errors
+        group.attrs['write_errors'] = self.write_errors
+        group.attrs['t_epoch_offset'] = self.t_epoch_offset
+        return n
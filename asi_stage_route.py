@@ -0,0 +1,141 @@
+'''
+Visiting order for many saved positions.
+
+Travel time between two sites is the time of the slowest axis: X, Y and
+Z move independently, each with its own speed, ramp and backlash
+(trapezoidal profile, see asi_stage_motion.py). This is Chebyshev-like,
+not Euclidean: a diagonal move costs no more than its longest leg.
+
+The route is an open path from a pinned start. It is seeded with
+nearest neighbour and improved with 2-opt (segment reversal) and Or-opt
+(moving runs of 1-3 sites). Backlash makes the time matrix slightly
+asymmetric; the search uses max(C, C.T) and the reported times use the
+actual direction of travel.
+'''
+import numpy as np
+
+from .asi_stage_motion import move_durations
+
+
+def travel_time_matrix(points, speeds, acc_ms=10.0, backlash=0.0, settle=0.0):
+    """
+    points: (N, D) positions in mm, D axes (x, y[, z])
+    speeds: per-axis speed in mm/s (len D); acc_ms and backlash may be
+        scalars or per-axis
+    returns C with C[i, j] = time (s) to move from site i to site j
+    """
+    P = np.asarray(points, dtype=float)
+    n, D = P.shape
+    acc_ms = np.broadcast_to(acc_ms, (D,))
+    backlash = np.broadcast_to(backlash, (D,))
+    C = np.zeros((n, n))
+    for k in range(D):
+        T = move_durations(P[:, None, k], P[None, :, k], speeds[k], acc_ms[k], backlash[k])
+        np.maximum(C, T, out=C)
+    C += np.where(np.eye(n, dtype=bool), 0.0, settle)
+    return C
+
+
+def route_time(order, C):
+    """total travel time along order (open path)"""
+    order = np.asarray(order)
+    return float(C[order[:-1], order[1:]].sum()) if len(order) > 1 else 0.0
+
+
+def nearest_neighbour(C, start=0):
+    n = len(C)
+    order = np.empty(n, dtype=int)
+    visited = np.zeros(n, dtype=bool)
+    order[0] = start
+    visited[start] = True
+    for k in range(1, n):
+        cost = np.where(visited, np.inf, C[order[k-1]])
+        order[k] = np.argmin(cost)
+        visited[order[k]] = True
+    return order
+
+
+def two_opt(order, D, max_passes=50):
+    """reverse segments while that shortens the path; order[0] stays fixed.
+    D must be symmetric."""
+    order = np.array(order)
+    n = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n-1):
+            # reverse order[i:j+1] for all j > i at once
+            a, b = order[i-1], order[i]
+            c = order[i+1:]
+            d = np.append(order[i+2:], -1)
+            delta = D[a, c] - D[a, b]
+            has_d = d >= 0
+            delta[has_d] += D[b, d[has_d]] - D[c[has_d], d[has_d]]
+            j = int(np.argmin(delta))
+            if delta[j] < -1e-12:
+                j += i+1
+                order[i:j+1] = order[i:j+1][::-1]
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def or_opt(order, C, max_passes=50, max_run=3):
+    """move runs of 1..max_run consecutive sites to the cheapest other
+    place in the path (keeping their direction); order[0] stays fixed"""
+    order = list(order)
+    n = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for run in range(1, max_run+1):
+            i = 1
+            while i + run <= n:
+                seg = order[i:i+run]
+                s0, s1 = seg[0], seg[-1]
+                p = order[i-1]
+                nxt = order[i+run] if i + run < n else None
+                gain = C[p, s0] + (C[s1, nxt] - C[p, nxt] if nxt is not None else 0.0)
+                rest = np.array(order[:i] + order[i+run:])
+                u = rest
+                v = np.append(rest[1:], -1)
+                has_v = v >= 0
+                # insert between u[k] and v[k] (or after the last site)
+                cost = C[u, s0].astype(float)
+                cost[has_v] += C[s1, v[has_v]] - C[u[has_v], v[has_v]]
+                k = int(np.argmin(cost))
+                if cost[k] < gain - 1e-12:
+                    order = list(rest[:k+1]) + seg + list(rest[k+1:])
+                    improved = True
+                else:
+                    i += 1
+        if not improved:
+            break
+    return np.array(order)
+
+
+def plan_route(points, start=0, speeds=(3.0, 3.0, 1.2), acc_ms=10.0, backlash=0.0,
+               settle=0.0, max_passes=50):
+    """
+    order in which to visit points, starting at (pinned) index start.
+    returns (order, time_before, time_after) where time_before is the
+    travel time in the given order (start first).
+    """
+    P = np.asarray(points, dtype=float)
+    n = len(P)
+    if n == 0:
+        return np.zeros(0, dtype=int), 0.0, 0.0
+    C = travel_time_matrix(P, speeds[:P.shape[1]], acc_ms, backlash, settle)
+    given = np.concatenate([[start], np.delete(np.arange(n), start)])
+    t_before = route_time(given, C)
+    if n < 3:
+        return given, t_before, t_before
+    D = np.maximum(C, C.T)
+    order = nearest_neighbour(D, start)
+    for _ in range(max_passes):
+        t = route_time(order, C)
+        order = or_opt(two_opt(order, D, max_passes), C, max_passes)
+        if route_time(order, C) >= t - 1e-12:
+            break
+    if route_time(order, C) > t_before:
+        order = given
+    return order, t_before, route_time(order, C)
@@ -0,0 +1,303 @@
+'''
+In-process simulator of an ASI LX-4000 controller.
+
+ASIStageSimulator is a drop-in replacement for the serial.Serial object
+used by ASIXYStage. It speaks the card-addressed protocol used by the
+driver (1H = Z card, 2H = XY card, 3F = filter wheel):
+
+    '2HW X'       -> ':A 12345 \\r\\n\\x03'
+    '2HM X= 100'  -> ':A \\r\\n\\x03'
+    '2H/'         -> 'N\\r\\n\\x03'  or 'B\\r\\n\\x03'
+    '2HI X'       -> several lines of info followed by '\\x03'
+
+Moves follow the trapezoidal profile in asi_stage_motion using the
+SPEED, AC and B (backlash) settings of each axis. Timing is fixed by
+the model: each reply becomes readable `latency` seconds plus the
+byte transfer time after the command is written.
+
+Controller quirk: move targets whose internal value ends in 3 are
+rejected (':N-4') and the axis does not move, see ASIXYStage._scale
+
+Ring buffer (firmware option, ring_buffer_size > 0):
+    '2HRM X=0'         clear the buffer
+    '2HLD X= .. Y= ..' append a position
+    '2HRM'             move to the next buffered position (wraps around)
+Without the option these commands are rejected with ':N-1'.
+
+usage:
+    stage = ASIXYStage(transport=ASIStageSimulator())
+'''
+import re
+import time
+
+from .asi_stage_motion import AxisMotion
+from .asi_stage_transport import TimedReplyTransport
+
+ETX = b'\x03'
+
+
+class SimAxis(object):
+
+    def __init__(self, name, speed=3.0, acc=10.0, backlash=0.0,
+                 home=0.0, settle=0.005):
+        self.name = name
+        self.speed = speed # mm/s
+        self.acc = acc # ms
+        self.backlash = backlash # mm
+        self.home = home # mm, absolute position of home switch
+        self.settle = settle # s
+        self.offset = 0.0 # mm, absolute position of user zero
+        self.motion = None
+        self._pos = 0.0 # mm, absolute position when not moving
+
+    def abs_position(self, t):
+        if self.motion is None:
+            return self._pos
+        return self.motion.position(t)
+
+    def position(self, t):
+        return self.abs_position(t) - self.offset
+
+    def is_busy(self, t):
+        return self.motion is not None and self.motion.is_busy(t)
+
+    def move_abs(self, target_abs, t):
+        start = self.abs_position(t)
+        self.motion = AxisMotion(start, target_abs, t, self.speed, self.acc,
+                                 self.backlash, self.settle)
+        self._pos = target_abs
+
+    def halt(self, t):
+        self._pos = self.abs_position(t)
+        self.motion = None
+
+    def set_here(self, value, t):
+        self.halt(t)
+        self.offset = self._pos - value
+
+
+class ASIStageSimulator(TimedReplyTransport):
+
+    # reply codes of the LX-4000
+    ERR_UNKNOWN_CMD = ':N-1'
+    ERR_UNKNOWN_AXIS = ':N-2'
+    ERR_MISSING_PARAM = ':N-3'
+    ERR_OUT_OF_RANGE = ':N-4'
+
+    def __init__(self, port='SIM', timeout=0.02, baudrate=115200, latency=0.002,
+                 ring_buffer_size=50, clock=time.monotonic, sleep=time.sleep):
+        TimedReplyTransport.__init__(self, timeout, clock, sleep)
+        self.port = port
+        self.baudrate = baudrate
+        self.latency = latency # controller processing time per command (s)
+
+        self.unit_scale = 1e4 # internal units 1/10um per mm
+        self.cards = {
+            '1': {'Z': SimAxis('Z', speed=1.2, home=25.0)},
+            '2': {'X': SimAxis('X', home=45.0), 'Y': SimAxis('Y', home=45.0)},
+            }
+        self.fw_position = 1
+        
+        self.ring_buffer_size = ring_buffer_size
+        self.ring_buffers = dict((card, []) for card in self.cards)
+        self.ring_pointers = dict((card, 0) for card in self.cards)
+        self._card = None # card addressed by the command being handled
+
+    def handle_line(self, cmd, t):
+        reply = self.handle_command(cmd.decode(errors='replace'), t)
+        if reply is not None:
+            self._queue(t + self.latency + len(reply)*10.0/self.baudrate, reply)
+
+    # controller
+
+    def axis(self, card, name):
+        return self.cards.get(card, {}).get(name)
+
+    def handle_command(self, cmd, t):
+        m = re.match(r'\s*(\d)([A-Z])\s*(.*)$', cmd)
+        if not m:
+            return self._reply(self.ERR_UNKNOWN_CMD)
+        card, card_type, rest = m.groups()
+        if card_type == 'F':
+            return self._handle_fw(rest.strip())
+        axes = self.cards.get(card)
+        if axes is None:
+            return self._reply(self.ERR_UNKNOWN_CMD)
+        self._card = card
+        rest = rest.strip()
+        if rest.startswith('/'):
+            busy = any(ax.is_busy(t) for ax in axes.values())
+            return (b'B' if busy else b'N') + b'\r\n' + ETX
+        m = re.match(r'([A-Z]+)\s*(.*)$', rest)
+        if not m:
+            return self._reply(self.ERR_UNKNOWN_CMD)
+        verb, args = m.groups()
+        handler = getattr(self, 'cmd_' + self.VERBS.get(verb, '_unknown'))
+        try:
+            return handler(axes, args, t)
+        except KeyError:
+            return self._reply(self.ERR_UNKNOWN_AXIS)
+        except ValueError:
+            return self._reply(self.ERR_MISSING_PARAM)
+
+    VERBS = {'W': 'where', 'WHERE': 'where',
+             'M': 'move', 'MOVE': 'move',
+             'R': 'movrel', 'MOVREL': 'movrel',
+             'HALT': 'halt',
+             'HOME': 'home',
+             'H': 'here', 'HERE': 'here',
+             'Z': 'zero', 'ZERO': 'zero',
+             'S': 'speed', 'SPEED': 'speed',
+             'AC': 'accel', 'ACCEL': 'accel',
+             'B': 'backlash', 'BACKLASH': 'backlash',
+             'SL': 'limits', 'SU': 'limits', 'E': 'limits', 'PC': 'limits',
+             'DE': 'ok',
+             'I': 'info', 'INFO': 'info',
+             'LD': 'load', 'LOAD': 'load',
+             'RM': 'rbmode', 'RBMODE': 'rbmode',
+             }
+
+    @staticmethod
+    def _reply(text):
+        return text.encode() + b'\r\n' + ETX
+
+    @staticmethod
+    def _assignments(args):
+        """'X= 12 Y=-3.5' --> [('X', 12.0), ('Y', -3.5)]"""
+        pairs = re.findall(r'([A-Z])\s*=\s*([-+]?[\d.]+(?:[eE][-+]?\d+)?)', args)
+        return [(a, float(v)) for a, v in pairs]
+
+    @staticmethod
+    def _axis_names(args):
+        return re.findall(r'\b([A-Z])\b', args)
+
+    def cmd__unknown(self, axes, args, t):
+        return self._reply(self.ERR_UNKNOWN_CMD)
+
+    def cmd_ok(self, axes, args, t):
+        return self._reply(':A')
+
+    def cmd_where(self, axes, args, t):
+        names = self._axis_names(args) or list(axes)
+        vals = [int(round(axes[a].position(t)*self.unit_scale)) for a in names]
+        return self._reply(':A ' + ' '.join(str(v) for v in vals) + ' ')
+
+    def _move(self, axes, targets, t):
+        if not targets:
+            raise ValueError()
+        for a, v in targets:
+            axes[a] # raise KeyError on unknown axis
+            if abs(int(v)) % 10 == 3: # controller bug
+                return self._reply(self.ERR_OUT_OF_RANGE)
+        for a, v in targets:
+            ax = axes[a]
+            ax.move_abs(v/self.unit_scale + ax.offset, t)
+        return self._reply(':A')
+
+    def cmd_move(self, axes, args, t):
+        return self._move(axes, self._assignments(args), t)
+
+    def cmd_movrel(self, axes, args, t):
+        targets = [(a, axes[a].position(t)*self.unit_scale + v)
+                   for a, v in self._assignments(args)]
+        # relative moves do not suffer from the trailing-3 bug
+        for a, v in targets:
+            ax = axes[a]
+            ax.move_abs(v/self.unit_scale + ax.offset, t)
+        return self._reply(':A')
+
+    def cmd_halt(self, axes, args, t):
+        for ax in axes.values():
+            ax.halt(t)
+        return self._reply(':A')
+
+    def cmd_home(self, axes, args, t):
+        for a in (self._axis_names(args) or list(axes)):
+            ax = axes[a]
+            ax.move_abs(ax.home, t)
+        return self._reply(':A')
+
+    def cmd_here(self, axes, args, t):
+        for a, v in self._assignments(args):
+            axes[a].set_here(v/self.unit_scale, t)
+        return self._reply(':A')
+
+    def cmd_zero(self, axes, args, t):
+        for ax in axes.values():
+            ax.set_here(0.0, t)
+        return self._reply(':A')
+
+    def _setting(self, axes, args, attr, fmt):
+        queries = re.findall(r'([A-Z])\?', args)
+        if queries:
+            return self._reply(':A ' + ' '.join(
+                '{}={}'.format(a, fmt.format(getattr(axes[a], attr))) for a in queries))
+        for a, v in self._assignments(args):
+            setattr(axes[a], attr, v)
+        return self._reply(':A')
+
+    def cmd_speed(self, axes, args, t):
+        return self._setting(axes, args, 'speed', '{:f}')
+
+    def cmd_accel(self, axes, args, t):
+        return self._setting(axes, args, 'acc', '{:.0f}')
+
+    def cmd_backlash(self, axes, args, t):
+        return self._setting(axes, args, 'backlash', '{:f}')
+
+    def cmd_limits(self, axes, args, t):
+        for a, v in self._assignments(args):
+            axes[a]
+        return self._reply(':A')
+
+    def cmd_load(self, axes, args, t):
+        if self.ring_buffer_size <= 0:
+            return self._reply(self.ERR_UNKNOWN_CMD)
+        buf = self.ring_buffers[self._card]
+        targets = self._assignments(args)
+        if not targets:
+            raise ValueError()
+        if len(buf) >= self.ring_buffer_size:
+            return self._reply(self.ERR_OUT_OF_RANGE)
+        for a, v in targets:
+            axes[a]
+        buf.append(targets)
+        return self._reply(':A')
+
+    def cmd_rbmode(self, axes, args, t):
+        if self.ring_buffer_size <= 0:
+            return self._reply(self.ERR_UNKNOWN_CMD)
+        card = self._card
+        buf = self.ring_buffers[card]
+        for a, v in self._assignments(args):
+            if a == 'X' and v == 0: # clear
+                del buf[:]
+                self.ring_pointers[card] = 0
+        if args.strip() == '':
+            # software trigger: move to next buffered position
+            if not buf:
+                return self._reply(self.ERR_OUT_OF_RANGE)
+            i = self.ring_pointers[card]
+            self.ring_pointers[card] = (i + 1) % len(buf)
+            return self._move(axes, buf[i], t)
+        return self._reply(':A')
+
+    def cmd_info(self, axes, args, t):
+        lines = []
+        for a in (self._axis_names(args) or list(axes)):
+            ax = axes[a]
+            lines += ['Axis Name        : {}'.format(ax.name),
+                      'Max Speed        : {:f} mm/s'.format(ax.speed),
+                      'Ramp Time        : {:f} ms'.format(ax.acc),
+                      'Backlash         : {:f} mm'.format(ax.backlash),
+                      'Position         : {:f} mm'.format(ax.position(t)),
+                      ]
+        return ''.join(l + '\r\n' for l in lines).encode() + ETX
+
+    def _handle_fw(self, rest):
+        if rest.startswith('/'):
+            return b'N\r\n' + ETX
+        m = re.match(r'MP\s*(\d+)', rest)
+        if m:
+            self.fw_position = int(m.group(1))
+        return self._reply(':A')
@@ -0,0 +1,132 @@
+'''
+Grid-bucket spatial index over named XY positions.
+
+The plane is divided into square cells of size cell (mm); each cell
+holds the names of the sites inside it. Add and remove are O(1);
+nearest() searches rings of cells outwards from the query point and
+within() only visits the cells overlapping the circle, so lookups do
+not depend on the total number of sites.
+'''
+import math
+
+
+class GridIndex(object):
+
+    def __init__(self, cell=1.0):
+        self.cell = float(cell)
+        self.buckets = dict() # (i, j) -> {name: (x, y)}
+        self.positions = dict() # name -> (x, y)
+        self._bounds = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def _key(self, x, y):
+        return (int(math.floor(x/self.cell)), int(math.floor(y/self.cell)))
+
+    def add(self, name, x, y):
+        """add or move site name"""
+        if name in self.positions:
+            self.remove(name)
+        self.positions[name] = (x, y)
+        key = self._key(x, y)
+        self.buckets.setdefault(key, dict())[name] = (x, y)
+        if self._bounds is not None:
+            i, j = key
+            b = self._bounds
+            self._bounds = (min(b[0], i), max(b[1], i), min(b[2], j), max(b[3], j))
+
+    def remove(self, name):
+        x, y = self.positions.pop(name)
+        key = self._key(x, y)
+        bucket = self.buckets[key]
+        del bucket[name]
+        if not bucket:
+            del self.buckets[key]
+            self._bounds = None
+
+    def clear(self):
+        self.buckets.clear()
+        self.positions.clear()
+        self._bounds = None
+
+    def rebuild(self, items):
+        """replace the contents with items: iterable of (name, x, y)"""
+        self.clear()
+        for name, x, y in items:
+            self.add(name, x, y)
+
+    def _ring(self, i0, j0, r):
+        """cell keys at Chebyshev distance r from (i0, j0)"""
+        if r == 0:
+            yield (i0, j0)
+            return
+        for i in range(i0-r, i0+r+1):
+            yield (i, j0-r)
+            yield (i, j0+r)
+        for j in range(j0-r+1, j0+r):
+            yield (i0-r, j)
+            yield (i0+r, j)
+
+    def _cell_bounds(self):
+        """(i_min, i_max, j_min, j_max) of the occupied cells"""
+        if self._bounds is None:
+            keys = list(self.buckets.keys())
+            self._bounds = (min(i for i, j in keys), max(i for i, j in keys),
+                            min(j for i, j in keys), max(j for i, j in keys))
+        return self._bounds
+
+    def nearest(self, x, y, k=1):
+        """list of up to k (distance, name) pairs, closest first"""
+        if not self.positions:
+            return []
+        k = min(k, len(self.positions))
+        i0, j0 = self._key(x, y)
+        i_min, i_max, j_min, j_max = self._cell_bounds()
+        r_max = max(abs(i0 - i_min), abs(i0 - i_max), abs(j0 - j_min), abs(j0 - j_max))
+        found = []
+        for r in range(r_max+1):
+            for key in self._ring(i0, j0, r):
+                bucket = self.buckets.get(key)
+                if bucket:
+                    for name, (px, py) in bucket.items():
+                        found.append((math.hypot(px - x, py - y), name))
+            if len(found) >= k:
+                found.sort()
+                # sites in rings further out are at least r*cell away
+                if found[k-1][0] <= r*self.cell:
+                    break
+        found.sort()
+        return found[:k]
+
+    def within(self, x, y, radius):
+        """names of all sites within radius (mm) of (x, y), closest first"""
+        i0, j0 = self._key(x - radius, y - radius)
+        i1, j1 = self._key(x + radius, y + radius)
+        found = []
+        for i in range(i0, i1+1):
+            for j in range(j0, j1+1):
+                bucket = self.buckets.get((i, j))
+                if bucket:
+                    for name, (px, py) in bucket.items():
+                        d = math.hypot(px - x, py - y)
+                        if d <= radius:
+                            found.append((d, name))
+        found.sort()
+        return [name for d, name in found]
+
+    def in_box(self, x0, x1, y0, y1):
+        """names of all sites with x0 <= x <= x1 and y0 <= y <= y1"""
+        i0, j0 = self._key(x0, y0)
+        i1, j1 = self._key(x1, y1)
+        found = []
+        for i in range(i0, i1+1):
+            for j in range(j0, j1+1):
+                bucket = self.buckets.get((i, j))
+                if bucket:
+                    found.extend(name for name, (px, py) in bucket.items()
+                                 if x0 <= px <= x1 and y0 <= py <= y1)
+        return found
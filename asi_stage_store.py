@@ -0,0 +1,214 @@
+'''
+SQLite store for saved stage positions.
+
+Tables:
+    sessions   id, name, created
+    positions  id, session_id, name, x, y, z, seq, modified
+               (unique name per session, seq gives the list order)
+    tags       position_id, tag
+    focus_points  id, session_id, x, y, z  (in-focus points of the focus map)
+
+Every add/move and delete is a single-row write, so nothing has to be
+rewritten when the list grows. Whole lists move in and out as NumPy
+arrays (names, xyz), with .npz and HDF5 files for exchange.
+'''
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created REAL);
+CREATE TABLE IF NOT EXISTS positions (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    x REAL, y REAL, z REAL,
+    seq INTEGER NOT NULL,
+    modified REAL,
+    UNIQUE (session_id, name));
+CREATE INDEX IF NOT EXISTS positions_seq ON positions (session_id, seq);
+CREATE TABLE IF NOT EXISTS tags (
+    position_id INTEGER NOT NULL REFERENCES positions(id) ON DELETE CASCADE,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (position_id, tag));
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+CREATE TABLE IF NOT EXISTS focus_points (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    x REAL, y REAL, z REAL);
+"""
+
+
+class PositionStore(object):
+
+    def __init__(self, path=':memory:', session='default'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        if path != ':memory:':
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+        self.open_session(session)
+
+    def close(self):
+        self.db.close()
+
+    def open_session(self, name):
+        """make session name (created if new) the current one"""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO sessions (name, created) VALUES (?, ?)",
+                            (name, time.time()))
+            self.session_id, = self.db.execute(
+                "SELECT id FROM sessions WHERE name = ?", (name,)).fetchone()
+            self._next_seq, = self.db.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM positions WHERE session_id = ?",
+                (self.session_id,)).fetchone()
+        self.session = name
+
+    def sessions(self):
+        return [row[0] for row in self.db.execute("SELECT name FROM sessions ORDER BY id")]
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM positions WHERE session_id = ?",
+                               (self.session_id,)).fetchone()[0]
+
+    def put(self, name, x, y, z):
+        """add position name at the end of the list, or move it in place"""
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO positions (session_id, name, x, y, z, seq, modified) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (session_id, name) DO UPDATE SET "
+                "x = excluded.x, y = excluded.y, z = excluded.z, modified = excluded.modified",
+                (self.session_id, name, x, y, z, self._next_seq, time.time()))
+            self._next_seq += 1
+
+    def put_many(self, names, xyz):
+        """bulk put in one transaction"""
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        t = time.time()
+        seq0 = self._next_seq
+        rows = ((self.session_id, str(name), float(x), float(y), float(z), seq0 + k, t)
+                for k, (name, (x, y, z)) in enumerate(zip(names, xyz)))
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO positions (session_id, name, x, y, z, seq, modified) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (session_id, name) DO UPDATE SET "
+                "x = excluded.x, y = excluded.y, z = excluded.z, modified = excluded.modified",
+                rows)
+            self._next_seq = seq0 + len(xyz)
+
+    def delete(self, name):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM positions WHERE session_id = ? AND name = ?",
+                            (self.session_id, name))
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM positions WHERE session_id = ?", (self.session_id,))
+            self._next_seq = 0
+
+    def get(self, name):
+        row = self.db.execute("SELECT x, y, z FROM positions WHERE session_id = ? AND name = ?",
+                              (self.session_id, name)).fetchone()
+        return tuple(row) if row else None
+
+    def set_order(self, names):
+        """store the list order, names of all positions"""
+        with self.lock, self.db:
+            self.db.executemany("UPDATE positions SET seq = ? WHERE session_id = ? AND name = ?",
+                                ((k, self.session_id, name) for k, name in enumerate(names)))
+            self._next_seq = max(self._next_seq, len(names))
+
+    def to_arrays(self):
+        """(names, xyz) of the current session in list order"""
+        rows = self.db.execute("SELECT name, x, y, z FROM positions WHERE session_id = ? ORDER BY seq",
+                               (self.session_id,)).fetchall()
+        if not rows:
+            return [], np.zeros((0, 3))
+        names, x, y, z = zip(*rows)
+        return list(names), np.column_stack([x, y, z]).astype(float)
+
+    def tag(self, name, tag):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO tags (position_id, tag) "
+                "SELECT id, ? FROM positions WHERE session_id = ? AND name = ?",
+                (tag, self.session_id, name))
+
+    def untag(self, name, tag):
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM tags WHERE tag = ? AND position_id = "
+                "(SELECT id FROM positions WHERE session_id = ? AND name = ?)",
+                (tag, self.session_id, name))
+
+    def tags(self, name):
+        return [row[0] for row in self.db.execute(
+            "SELECT tag FROM tags JOIN positions ON positions.id = tags.position_id "
+            "WHERE session_id = ? AND name = ? ORDER BY tag", (self.session_id, name))]
+
+    def names_with_tag(self, tag):
+        return [row[0] for row in self.db.execute(
+            "SELECT name FROM positions JOIN tags ON positions.id = tags.position_id "
+            "WHERE session_id = ? AND tag = ? ORDER BY seq", (self.session_id, tag))]
+
+    def add_focus_point(self, x, y, z):
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO focus_points (session_id, x, y, z) VALUES (?, ?, ?, ?)",
+                            (self.session_id, x, y, z))
+
+    def set_focus_points(self, points):
+        """replace the focus points of the session with points (N, 3)"""
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM focus_points WHERE session_id = ?", (self.session_id,))
+            self.db.executemany("INSERT INTO focus_points (session_id, x, y, z) VALUES (?, ?, ?, ?)",
+                                ((self.session_id, x, y, z) for x, y, z in points.tolist()))
+
+    def clear_focus_points(self):
+        self.set_focus_points([])
+
+    def focus_points(self):
+        """(N, 3) array of the session's focus points, in the order added"""
+        rows = self.db.execute("SELECT x, y, z FROM focus_points WHERE session_id = ? ORDER BY id",
+                               (self.session_id,)).fetchall()
+        return np.array(rows, dtype=float).reshape(-1, 3)
+
+
+def save_npz(fname, names, xyz, **extra):
+    np.savez_compressed(fname, names=np.array(names, dtype=str),
+                        xyz=np.asarray(xyz, dtype=float).reshape(-1, 3), **extra)
+
+
+def load_npz(fname):
+    """returns names, xyz, dict of other arrays"""
+    with np.load(fname) as f:
+        extra = {k: f[k] for k in f.files if k not in ('names', 'xyz')}
+        return [str(name) for name in f['names']], f['xyz'], extra
+
+
+def save_h5(fname, names, xyz, **extra):
+    import h5py
+    with h5py.File(fname, 'w') as h5:
+        h5.create_dataset('names', data=np.array(names, dtype=object), dtype=h5py.string_dtype())
+        h5.create_dataset('xyz', data=np.asarray(xyz, dtype=float).reshape(-1, 3))
+        for k, v in extra.items():
+            h5.create_dataset(k, data=v)
+
+
+def load_h5(fname):
+    """returns names, xyz, dict of other arrays"""
+    import h5py
+    with h5py.File(fname, 'r') as h5:
+        names = [n.decode() if isinstance(n, bytes) else str(n) for n in h5['names'][()]]
+        extra = {k: h5[k][()] for k in h5.keys() if k not in ('names', 'xyz')}
+        return names, h5['xyz'][()], extra
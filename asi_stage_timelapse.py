@@ -0,0 +1,169 @@
+'''
+Multi-position time-lapse.
+
+Visits the saved positions of ASIStagePositionList in list order (or
+only those with site_tag) for n_rounds rounds. At every site the stage
+settles, waits dwell, and acquire() is called. The move to the next site
+(after the last site: back to the first) is issued the moment acquire()
+returns; process() for the data just taken then runs while the stage is
+travelling.
+
+Rounds start on a fixed schedule t0 + k*period on the monotonic clock.
+A late round starts at once and its lateness is reported as slip; the
+schedule does not shift, so delays do not accumulate.
+
+Subclasses override acquire() and process().
+'''
+from ScopeFoundry import Measurement, h5_io
+import time
+import numpy as np
+
+ROUND_STATS_DTYPE = np.dtype([('t_start', 'f8'), ('slip', 'f8'), ('duration', 'f8'),
+                              ('move_mean', 'f8'), ('move_max', 'f8'), ('acquire_mean', 'f8')])
+
+
+class ASIStageTimeLapse(Measurement):
+
+    name = 'asi_stage_timelapse'
+
+    def __init__(self, app, name=None, hw_name='asi_stage', pos_list_name='asi_stage_position_list'):
+        self.hw_name = hw_name
+        self.pos_list_name = pos_list_name
+        Measurement.__init__(self, app, name=name)
+
+    def setup(self):
+        S = self.settings
+        S.New('n_rounds', dtype=int, initial=10, vmin=1)
+        S.New('period', dtype=float, initial=60.0, unit='s', vmin=0)
+        S.New('dwell', dtype=float, initial=0.0, unit='s', vmin=0)
+        # only sites with this tag ('' = all saved positions)
+        S.New('site_tag', dtype=str, initial='')
+        S.New('save_h5', dtype=bool, initial=True)
+        S.New('round', dtype=int, initial=0, ro=True)
+        S.New('site', dtype=str, initial='', ro=True)
+        S.New('last_slip', dtype=float, initial=0.0, ro=True, unit='s', spinbox_decimals=3)
+        S.New('mean_round_time', dtype=float, initial=0.0, ro=True, unit='s', spinbox_decimals=3)
+
+        self.stage = self.app.hardware[self.hw_name]
+
+    def sites(self):
+        """(names, xyz) of the sites to visit, in order"""
+        pos_list = self.app.measurements[self.pos_list_name]
+        names, xyz = pos_list.saved_arrays()
+        tag = self.settings['site_tag']
+        if tag:
+            tagged = set(pos_list.store.names_with_tag(tag))
+            keep = [k for k, name in enumerate(names) if name in tagged]
+            names, xyz = [names[k] for k in keep], xyz[keep]
+        return names, xyz
+
+    def acquire(self, round_i, site_i, name):
+        """override: acquire at the current site, return data for process()"""
+        return None
+
+    def process(self, round_i, site_i, name, data):
+        """override: handle data of a site while the stage moves on"""
+        pass
+
+    def move_to(self, x, y, z):
+        self.stage.move_xy(x, y)
+        if self.stage.enable_z:
+            self.stage.move_z(z)
+
+    def wait_arrived(self):
+        # XY and Z in one combined poll
+        self.stage.wait_until_not_busy_xyz()
+
+    def sleep_until(self, t):
+        """sleep until monotonic time t or an interrupt"""
+        while not self.interrupt_measurement_called:
+            dt = t - time.monotonic()
+            if dt <= 0:
+                return
+            time.sleep(min(dt, 0.05))
+
+    def run(self):
+        S = self.settings
+        names, xyz = self.sites()
+        if not names:
+            print(self.name, 'no sites to visit')
+            return
+        n_rounds = S['n_rounds']
+        n_sites = len(names)
+        self.round_stats = np.zeros(n_rounds, dtype=ROUND_STATS_DTYPE)
+        self.move_times = np.full((n_rounds, n_sites), np.nan)
+        self.acquire_times = np.full((n_rounds, n_sites), np.nan)
+        rounds_done = 0
+
+        self.stage.begin_motion_session()
+        try:
+            t_move = time.monotonic()
+            self.move_to(*xyz[0])
+            t0 = None
+            for r in range(n_rounds):
+                # the stage returns to the first site as soon as the
+                # previous round is done, then waits for the schedule
+                self.wait_arrived()
+                self.move_times[r, 0] = time.monotonic() - t_move
+                if t0 is None:
+                    t0 = time.monotonic()
+                t_target = t0 + r*S['period']
+                self.sleep_until(t_target)
+                if self.interrupt_measurement_called:
+                    break
+                t_start = time.monotonic()
+                slip = t_start - t_target
+                if slip > 0.001 and r > 0:
+                    print('{} round {} started {:.3f} s late'.format(self.name, r, slip))
+                S['round'] = r
+                S['last_slip'] = slip
+                
+                for k in range(n_sites):
+                    if self.interrupt_measurement_called:
+                        break
+                    if k > 0:
+                        self.wait_arrived()
+                        self.move_times[r, k] = time.monotonic() - t_move
+                    S['site'] = names[k]
+                    if S['dwell'] > 0:
+                        self.sleep_until(time.monotonic() + S['dwell'])
+                        if self.interrupt_measurement_called:
+                            break
+                    t_acq = time.monotonic()
+                    data = self.acquire(r, k, names[k])
+                    t_move = time.monotonic()
+                    self.acquire_times[r, k] = t_move - t_acq
+                    if k + 1 < n_sites:
+                        self.move_to(*xyz[k+1])
+                    elif r + 1 < n_rounds:
+                        self.move_to(*xyz[0])
+                    # runs while the stage travels
+                    self.process(r, k, names[k], data)
+                    self.set_progress(100.0*(r*n_sites + k + 1)/(n_rounds*n_sites))
+                if self.interrupt_measurement_called:
+                    # only complete rounds are kept
+                    break
+                
+                duration = time.monotonic() - t_start
+                self.round_stats[r] = (t_start - t0, slip, duration,
+                                       np.nanmean(self.move_times[r]), np.nanmax(self.move_times[r]),
+                                       np.nanmean(self.acquire_times[r]))
+                rounds_done = r + 1
+                S['mean_round_time'] = float(self.round_stats['duration'][:rounds_done].mean())
+        finally:
+            self.stage.end_motion_session()
+            if S['save_h5'] and rounds_done:
+                self.save_stats(names, xyz, rounds_done)
+
+    def save_stats(self, names, xyz, n):
+        """save the statistics of the first n (completed) rounds"""
+        self.h5_file = h5_io.h5_base_file(app=self.app, measurement=self)
+        try:
+            H = h5_io.h5_create_measurement_group(measurement=self, h5group=self.h5_file)
+            H['site_names'] = np.array(names, dtype='S')
+            H['site_xyz'] = xyz
+            H['round_stats'] = self.round_stats[:n]
+            H['move_times'] = self.move_times[:n]
+            H['acquire_times'] = self.acquire_times[:n]
+        finally:
+            self.h5_file.close()
@@ -0,0 +1,213 @@
+'''
+Serial traffic recording and replay for ASI controllers.
+
+TrafficRecorder wraps the serial port (or any serial.Serial-like
+transport) of ASIXYStage and logs every write and every read, with
+time.monotonic() timestamps, to a compact binary file:
+
+    header   b'ASITRAF1', t0 (monotonic, f8), epoch time at t0 (f8)
+    record   direction (u1: 0 write, 1 read), t - t0 (f8), length (u4), bytes
+
+Reads that return nothing (serial timeouts) are logged with length 0.
+
+TrafficReplay plays a log back to the driver in place of the port. The
+log is split into commands, each with its reply frame (up to ETX) and
+the controller's latency: time from the write to the read that
+completed the frame. A command written by the driver is answered with
+the recorded frame after the recorded latency divided by speed
+(speed=None: at once), so the controller's timing is reproduced while
+the driver and scan loop run at their own pace.
+
+Commands are matched in recorded order. Background polls depend on GUI
+timing and will not line up exactly: a command found a few places ahead
+skips the ones in between, a command missing from the recording is
+answered with the reply to its closest recorded occurrence. Both are
+counted (see stats()); strict=True raises ReplayMismatch instead.
+
+usage:
+    stage = ASIXYStage(port='COM4', traffic_log='scan.asitraffic')
+    ...
+    stage = ASIXYStage(transport=TrafficReplay('scan.asitraffic', speed=4.0))
+'''
+import struct
+import threading
+import time
+from collections import deque
+
+from .asi_stage_transport import TimedReplyTransport
+
+MAGIC = b'ASITRAF1'
+HEADER = struct.Struct('<dd')
+RECORD = struct.Struct('<BdI')
+WRITE = 0
+READ = 1
+ETX = b'\x03'
+ABORT = b'\x08' # <bs>, aborts the current command and flushes the buffers
+
+
+class TrafficRecorder(object):
+
+    def __init__(self, transport, fname):
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.file = open(fname, 'wb')
+        self.t0 = time.monotonic()
+        self.file.write(MAGIC + HEADER.pack(self.t0, time.time()))
+
+    def _log(self, direction, data):
+        t = time.monotonic() - self.t0
+        with self.lock:
+            if self.file is not None:
+                self.file.write(RECORD.pack(direction, t, len(data)) + data)
+
+    def write(self, data):
+        n = self.transport.write(data)
+        self._log(WRITE, bytes(data))
+        return n
+
+    def read(self, size=1):
+        data = self.transport.read(size)
+        self._log(READ, data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.transport.readline(size)
+        self._log(READ, data)
+        return data
+
+    @property
+    def in_waiting(self):
+        return self.transport.in_waiting
+
+    def reset_input_buffer(self):
+        self.transport.reset_input_buffer()
+
+    def flush(self):
+        self.transport.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        self.transport.close()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_traffic(fname):
+    """returns (t0, epoch, records), records: list of (direction, t, data)
+    with t in s from t0"""
+    with open(fname, 'rb') as f:
+        buf = f.read()
+    if not buf.startswith(MAGIC):
+        raise IOError("{} is not an ASI traffic log".format(fname))
+    t0, epoch = HEADER.unpack_from(buf, len(MAGIC))
+    i = len(MAGIC) + HEADER.size
+    records = []
+    while i + RECORD.size <= len(buf):
+        direction, t, n = RECORD.unpack_from(buf, i)
+        i += RECORD.size
+        records.append((direction, t, buf[i:i+n]))
+        i += n
+    return t0, epoch, records
+
+
+def split_commands(records):
+    """list of (t_write, cmd, frame, latency) in written order. cmd
+    without the trailing <cr>, frame with its ETX (None if the controller
+    never answered), latency in s"""
+    commands = []
+    waiting = deque() # indices of commands without a reply yet
+    pending = bytearray()
+    rx = bytearray()
+    for direction, t, data in records:
+        if direction == WRITE:
+            for b in data:
+                if b == ABORT[0]:
+                    pending.clear()
+                    rx.clear()
+                    waiting.clear()
+                elif b == 0x0D:
+                    commands.append([t, bytes(pending), None, None])
+                    waiting.append(len(commands) - 1)
+                    pending.clear()
+                else:
+                    pending.append(b)
+        else:
+            rx += data
+            while True:
+                i = rx.find(ETX)
+                if i < 0:
+                    break
+                frame = bytes(rx[:i+1])
+                del rx[:i+1]
+                if waiting:
+                    c = commands[waiting.popleft()]
+                    c[2] = frame
+                    c[3] = t - c[0]
+    return [tuple(c) for c in commands]
+
+
+class ReplayMismatch(IOError):
+    pass
+
+
+class TrafficReplay(TimedReplyTransport):
+
+    def __init__(self, fname, speed=1.0, strict=False, window=20, timeout=0.02,
+                 clock=time.monotonic, sleep=time.sleep):
+        """speed: latencies are divided by speed, None replies at once
+        window: how far ahead (commands) a written command is looked up"""
+        TimedReplyTransport.__init__(self, timeout, clock, sleep)
+        self.fname = fname
+        self.speed = speed
+        self.strict = strict
+        self.window = window
+        t0, epoch, records = read_traffic(fname)
+        self.commands = split_commands(records)
+        self.occurrences = dict() # cmd -> indices into self.commands
+        for k, c in enumerate(self.commands):
+            self.occurrences.setdefault(c[1], []).append(k)
+        self.pointer = 0
+        self.matched = 0
+        self.skipped = 0
+        self.substituted = 0
+        self.unmatched = 0
+
+    def stats(self):
+        return dict(commands=len(self.commands), position=self.pointer,
+                    matched=self.matched, skipped=self.skipped,
+                    substituted=self.substituted, unmatched=self.unmatched)
+
+    def lookup(self, cmd):
+        """index of the recorded command answering cmd, None if unknown"""
+        ks = self.occurrences.get(cmd)
+        if not ks:
+            self.unmatched += 1
+            if self.strict:
+                raise ReplayMismatch("command {!r} not in {}".format(cmd, self.fname))
+            return None
+        p = self.pointer
+        for k in ks:
+            if p <= k < p + self.window:
+                if k > p and self.strict:
+                    raise ReplayMismatch("command {!r} recorded {} commands later".format(cmd, k - p))
+                self.skipped += k - p
+                self.matched += 1
+                self.pointer = k + 1
+                return k
+        if self.strict:
+            raise ReplayMismatch("command {!r} out of order".format(cmd))
+        # closest recorded occurrence
+        self.substituted += 1
+        return min(ks, key=lambda k: abs(k - p))
+
+    def handle_line(self, cmd, t):
+        k = self.lookup(cmd)
+        if k is None:
+            return
+        frame, latency = self.commands[k][2:]
+        if frame is not None:
+            self._queue(t if not self.speed else t + latency/self.speed, frame)
@@ -0,0 +1,153 @@
+'''
+Precomputed motion program for slow raster scans.
+
+Built once before the scan from the scan arrays of BaseRaster2DSlowScan
+(scan_h_positions, scan_v_positions, scan_slow_move). The scan loop
+then only looks up pixel i instead of working out moves on the fly.
+
+All arrays have one entry per pixel:
+    h, v              sample target
+    stage_x, stage_y  stage target
+    approach_x/_y     stage pre-approach point of slow moves
+                      (line starts), equal to the target for fast moves
+    direction         +1 or -1, direction of travel along the line
+                      (serpentine scans alternate); reverse lines are
+                      shifted by reverse_offset
+    move_time         modelled time from previous target to arrival (s)
+    step_wait         time the scan waits after a fast move (s); fast
+                      moves are not waited on, the pixel is paced at
+                      step_wait_factor*|dh|/speed_xy
+    dwell             time spent on the pixel (s)
+    arrival           expected arrival time since scan start (s)
+    line_end          index of the first pixel of the next line
+'''
+import numpy as np
+
+from .asi_stage_motion import move_durations
+
+
+class RasterTrajectory(object):
+
+    def __init__(self, h, v, slow_move, transform, speed=(3.0, 3.0), acc_ms=10.0,
+                 backlash=0.0, pre_approach=0.02, dwell=0.0, settle=0.005,
+                 speed_xy=3.0, step_wait_factor=1.2, reverse_offset=0.0):
+        """
+        h, v: sample positions (mm) of each pixel in scan order
+        slow_move: bool array, True where a pixel starts a new line
+        transform: StageTransform sample -> stage
+        speed: (speed_x, speed_y) of stage axes in mm/s
+        pre_approach: line starts are approached from pre_approach (mm)
+            before h, against the direction of the line
+        reverse_offset: added to h on lines scanned in -h direction (mm)
+        """
+        self.h = h = np.asarray(h, dtype=float)
+        self.v = v = np.asarray(v, dtype=float)
+        self.slow_move = slow_move = np.asarray(slow_move, dtype=bool)
+        self.pre_approach = pre_approach
+        self.reverse_offset = reverse_offset
+        self.N = len(h)
+
+        starts = np.flatnonzero(slow_move)
+        next_start = np.searchsorted(starts, np.arange(self.N), side='right')
+        self.line_end = np.append(starts, self.N)[next_start]
+        line_start = np.append([0], starts)[next_start]
+        self.direction = np.where(h[self.line_end - 1] < h[line_start], -1.0, 1.0) if self.N else np.zeros(0)
+        h_cmd = np.where(self.direction < 0, h + reverse_offset, h)
+
+        self.stage_x, self.stage_y = transform.to_stage(h_cmd, v)
+        ax, ay = transform.to_stage(
+            np.where(slow_move, h_cmd - self.direction*pre_approach, h_cmd), v)
+        self.approach_x = np.where(slow_move, ax, self.stage_x)
+        self.approach_y = np.where(slow_move, ay, self.stage_y)
+
+        # previous stage target of each pixel (first pixel: its own)
+        prev_x = np.concatenate([self.stage_x[:1], self.stage_x[:-1]])
+        prev_y = np.concatenate([self.stage_y[:1], self.stage_y[:-1]])
+
+        def xy_time(x0, y0, x1, y1):
+            # axes move simultaneously, the slower one sets the time
+            return np.maximum(
+                move_durations(x0, x1, speed[0], acc_ms, backlash, settle),
+                move_durations(y0, y1, speed[1], acc_ms, backlash, settle))
+
+        t_direct = xy_time(prev_x, prev_y, self.stage_x, self.stage_y)
+        t_approach = (xy_time(prev_x, prev_y, self.approach_x, self.approach_y)
+                      + xy_time(self.approach_x, self.approach_y, self.stage_x, self.stage_y))
+        self.move_time = np.where(slow_move, t_approach, t_direct)
+        dh = np.abs(np.diff(h, prepend=h[:1]))
+        self.step_wait = np.where(slow_move, 0.0, step_wait_factor*dh/speed_xy)
+        self.dwell = np.broadcast_to(np.asarray(dwell, dtype=float), (self.N,)).copy()
+        t_step = np.where(slow_move, self.move_time, self.step_wait)
+        self.arrival = np.cumsum(t_step + np.concatenate([[0.0], self.dwell[:-1]]))
+
+    @classmethod
+    def from_scan(cls, scan, hw, pre_approach=0.02, dwell=None, reverse_offset=0.0):
+        """plan the scan arrays of a BaseRaster2DSlowScan measurement
+        using the speed/acceleration/backlash settings of ASIStageHW"""
+        S = hw.settings
+        if dwell is None:
+            dwell = scan.settings['pixel_time']
+        return cls(scan.scan_h_positions, scan.scan_v_positions, scan.scan_slow_move,
+                   hw.transform, speed=(S['speed_x'], S['speed_y']), acc_ms=S['acc_xy'],
+                   backlash=S['backlash_xy'], pre_approach=pre_approach, dwell=dwell,
+                   speed_xy=S['speed_xy'], reverse_offset=reverse_offset)
+
+    def matches(self, i, h, v):
+        """True if pixel i of the plan is at sample position (h, v)"""
+        return 0 <= i < self.N and abs(self.h[i] - h) < 1e-9 and abs(self.v[i] - v) < 1e-9
+
+    @property
+    def total_time(self):
+        return float(self.arrival[-1] + self.dwell[-1]) if self.N else 0.0
+
+
+def regrid_line(t_samples, values, t_encoder, h_encoder, h_pixels):
+    """
+    Resample detector samples taken while flying across a line onto the
+    pixel grid.
+
+    t_samples, values: monotonic timestamps and detector readings
+    t_encoder, h_encoder: sparse timestamped stage positions (sample h)
+    h_pixels: pixel centres of the line
+
+    Sample positions are interpolated from the encoder track, then the
+    readings are interpolated at the pixel centres. Pixels outside the
+    travelled range are NaN.
+    """
+    h_samples = np.interp(t_samples, t_encoder, h_encoder)
+    order = np.argsort(h_samples, kind='stable')
+    return np.interp(h_pixels, h_samples[order], np.asarray(values, dtype=float)[order],
+                     left=np.nan, right=np.nan)
+
+
+def direction_offset(forward, reverse, dh):
+    """
+    Shift (mm) of reverse lines relative to forward lines, from the
+    cross-correlation of the line pairs of a serpentine image.
+
+    forward, reverse: 2D arrays (lines, pixels), both in pixel order of
+    increasing h. dh: pixel size (mm). A positive result means features
+    appear at larger h on reverse lines; adding it to the reverse line
+    targets cancels the shift.
+    """
+    forward = np.nan_to_num(np.atleast_2d(np.asarray(forward, dtype=float)))
+    reverse = np.nan_to_num(np.atleast_2d(np.asarray(reverse, dtype=float)))
+    n = min(len(forward), len(reverse))
+    forward = forward[:n] - forward[:n].mean(axis=1, keepdims=True)
+    reverse = reverse[:n] - reverse[:n].mean(axis=1, keepdims=True)
+    N = forward.shape[1]
+    # zero padded FFT cross-correlation, summed over all line pairs
+    xc = np.fft.irfft(np.fft.rfft(reverse, 2*N)*np.conj(np.fft.rfft(forward, 2*N)), 2*N).sum(axis=0)
+    xc = np.roll(xc, N-1)[:2*N-1] # lags -(N-1) .. N-1
+    if not np.any(xc > 0):
+        # no common signal
+        return 0.0
+    k = int(np.argmax(xc))
+    lag = float(k - (N-1))
+    if 0 < k < len(xc)-1:
+        # sub-pixel peak from a parabola through the maximum
+        y0, y1, y2 = xc[k-1], xc[k], xc[k+1]
+        denom = y0 - 2*y1 + y2
+        if denom != 0:
+            lag += 0.5*(y0 - y2)/denom
+    return lag*dh
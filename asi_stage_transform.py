@@ -0,0 +1,87 @@
+'''
+Affine transform between sample and stage coordinates.
+
+    stage = matrix @ sample + offset
+
+The swap_xy / invert_x / invert_y wiring options of ASIStageHW are the
+special case of a signed permutation matrix. A calibration can add a
+sample rotation and skew. All conversions accept scalars or NumPy
+arrays, so whole scan grids convert in one vectorized call.
+'''
+import numpy as np
+
+
+class StageTransform(object):
+
+    def __init__(self, matrix=None, offset=(0.0, 0.0)):
+        if matrix is None:
+            matrix = np.eye(2)
+        self.matrix = np.array(matrix, dtype=float).reshape(2, 2)
+        self.offset = np.array(offset, dtype=float).reshape(2)
+        self.inverse = np.linalg.inv(self.matrix)
+
+    @classmethod
+    def from_flags(cls, swap_xy=False, invert_x=False, invert_y=False):
+        """sample x is read from stage x (or stage y if swap_xy),
+        negated if invert_x; likewise for sample y"""
+        sign_x = -1.0 if invert_x else 1.0
+        sign_y = -1.0 if invert_y else 1.0
+        if swap_xy:
+            matrix = [[0, sign_y], [sign_x, 0]]
+        else:
+            matrix = [[sign_x, 0], [0, sign_y]]
+        return cls(matrix)
+
+    def with_calibration(self, rotation=0.0, skew=0.0, offset=(0.0, 0.0)):
+        """new transform that first rotates (deg, counter-clockwise) and
+        skews (deg, x shear) sample coordinates, then applies this one.
+        offset (mm) is added in stage coordinates."""
+        th = np.deg2rad(rotation)
+        R = np.array([[np.cos(th), -np.sin(th)], [np.sin(th), np.cos(th)]])
+        K = np.array([[1.0, np.tan(np.deg2rad(skew))], [0.0, 1.0]])
+        return StageTransform(self.matrix @ R @ K, self.offset + np.asarray(offset, dtype=float))
+
+    def is_axis_aligned(self):
+        """True if each stage axis depends on only one sample axis"""
+        return np.count_nonzero(self.matrix) == 2 and all(np.count_nonzero(self.matrix, axis=1) == 1)
+
+    def to_stage(self, x, y):
+        """sample (x, y) -> stage (sx, sy); scalars or arrays"""
+        M, o = self.matrix, self.offset
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        sx = M[0, 0]*x + M[0, 1]*y + o[0]
+        sy = M[1, 0]*x + M[1, 1]*y + o[1]
+        if sx.ndim == 0:
+            return float(sx), float(sy)
+        return sx, sy
+
+    def to_sample(self, sx, sy):
+        """stage (sx, sy) -> sample (x, y); scalars or arrays"""
+        Mi, o = self.inverse, self.offset
+        sx = np.asarray(sx, dtype=float) - o[0]
+        sy = np.asarray(sy, dtype=float) - o[1]
+        x = Mi[0, 0]*sx + Mi[0, 1]*sy
+        y = Mi[1, 0]*sx + Mi[1, 1]*sy
+        if x.ndim == 0:
+            return float(x), float(y)
+        return x, y
+
+    def to_stage_vector(self, dx, dy):
+        """sample displacement -> stage displacement (no offset)"""
+        M = self.matrix
+        return (float(M[0, 0]*dx + M[0, 1]*dy),
+                float(M[1, 0]*dx + M[1, 1]*dy))
+
+    def stage_targets(self, x=None, y=None):
+        """stage targets for sample x and/or y. A stage axis that depends
+        on a coordinate given as None is returned as None (not moved)."""
+        M = self.matrix
+        given = (x is not None, y is not None)
+        sx, sy = self.to_stage(x if given[0] else 0.0, y if given[1] else 0.0)
+        out = [sx, sy]
+        for i in range(2):
+            for j in range(2):
+                if M[i, j] != 0 and not given[j]:
+                    out[i] = None
+        return tuple(out)
@@ -0,0 +1,112 @@
+'''
+Common base of the in-process stand-ins for the serial port
+(ASIStageSimulator, TrafficReplay).
+
+TimedReplyTransport implements the serial.Serial interface used by
+ASIXYStage. Written bytes are collected into commands (<cr> ends a
+command, <bs> aborts it and flushes the buffers) and handed to
+handle_line(cmd, t). Subclasses answer with _queue(t_ready, reply): the
+reply becomes readable at t_ready (clock time), replies are read in
+the order they were queued.
+'''
+import threading
+import time
+from collections import deque
+
+ABORT = 0x08 # <bs>
+CR = 0x0D
+
+
+class TimedReplyTransport(object):
+
+    def __init__(self, timeout=0.02, clock=time.monotonic, sleep=time.sleep):
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.is_open = True
+        self._in_buf = bytearray()
+        self._out = deque() # (t_ready, bytearray)
+        self.lock = threading.RLock()
+
+    def handle_line(self, cmd, t):
+        """override: cmd (bytes, without <cr>) was written at t"""
+        raise NotImplementedError
+
+    def _queue(self, t_ready, reply):
+        if self._out:
+            t_ready = max(t_ready, self._out[-1][0])
+        self._out.append((t_ready, bytearray(reply)))
+
+    # serial.Serial interface
+
+    def write(self, data):
+        with self.lock:
+            t = self.clock()
+            for b in bytes(data):
+                if b == ABORT: # abort current command and flush buffer
+                    self._in_buf.clear()
+                    self._out.clear()
+                elif b == CR: # end of command
+                    cmd = bytes(self._in_buf)
+                    self._in_buf.clear()
+                    self.handle_line(cmd, t)
+                else:
+                    self._in_buf.append(b)
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            now = self.clock()
+            return sum(len(r) for t_ready, r in self._out if t_ready <= now)
+
+    def _take(self, size, until=None):
+        """take up to size ready bytes, stopping after `until` byte"""
+        out = bytearray()
+        now = self.clock()
+        while self._out and len(out) < size:
+            t_ready, r = self._out[0]
+            if t_ready > now:
+                break
+            n = size - len(out)
+            if until is not None and until in r[:n]:
+                n = r.index(until) + 1
+                size = len(out) + n
+            out += r[:n]
+            del r[:n]
+            if not r:
+                self._out.popleft()
+        return bytes(out)
+
+    def _read(self, size, until=None):
+        deadline = None if self.timeout is None else self.clock() + self.timeout
+        out = b''
+        while True:
+            with self.lock:
+                out += self._take(size - len(out), until)
+                next_ready = self._out[0][0] if self._out else None
+            if len(out) >= size or (until is not None and out.endswith(until)):
+                return out
+            now = self.clock()
+            if deadline is not None and now >= deadline:
+                return out
+            wake = deadline if deadline is not None else now + 0.001
+            if next_ready is not None:
+                wake = min(wake, next_ready)
+            self.sleep(max(wake - now, 0.0001))
+
+    def read(self, size=1):
+        return self._read(size)
+
+    def readline(self, size=-1):
+        return self._read(size if size > 0 else 1 << 20, until=b'\n')
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self._out.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False